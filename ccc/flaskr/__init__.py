@@ -49,6 +49,80 @@ def create_app(test_config=None):
         SECRET_KEY="dev",
         # store the database in the instance folder
         DATABASE=os.path.join(app.instance_path, "flaskr.sqlite"),
+        # milliseconds to wait for a lock, and bytes of the database mapped
+        # in memory and cached by each connection
+        DATABASE_BUSY_TIMEOUT=5000,
+        DATABASE_MMAP_SIZE=256 * 1024 * 1024,
+        DATABASE_CACHE_SIZE=64 * 1024 * 1024,
+        # number of devices archived together by a single DNAC task
+        ARCHIVE_BATCH_SIZE=50,
+        # folder the raw archives downloaded from a DNAC are saved in,
+        # they are only read from memory unless it is set
+        ARCHIVE_FOLDER=None,
+        # "threads", or "asyncio" to keep every backup of a DNAC in flight
+        # on one thread, which requires aiohttp
+        BACKUP_ENGINE="threads",
+        # with the asyncio engine, archive tasks of a DNAC run at once, and
+        # RESTCONF connections open at once, in total and to each device
+        BACKUP_DNAC_CONCURRENCY=20,
+        BACKUP_RESTCONF_CONCURRENCY=200,
+        BACKUP_DEVICE_CONCURRENCY=1,
+        # scheduled jobs only back up the devices updated in their DNAC since
+        # their last backup, or whose backup failed, and back up every device
+        # again once its last backup is older than the seconds of a full sweep
+        BACKUP_INCREMENTAL=True,
+        BACKUP_FULL_SWEEP=7 * 24 * 3600,
+        # seconds between the first polls of a DNAC task, doubled after
+        # each poll up to the maximum
+        TASK_POLL_INTERVAL=1,
+        TASK_POLL_MAX_INTERVAL=30,
+        # seconds a DNAC token is reused before requesting a new one
+        DNAC_TOKEN_LIFETIME=3300,
+        # HTTPS connections kept open to each DNAC
+        DNAC_POOL_SIZE=20,
+        # calls per second, burst of calls and calls at once allowed for
+        # each class of API of a DNAC, and of RESTCONF on each device
+        API_LIMITS={
+            "auth": (0.5, 5, 2),
+            "archive": (0.5, 5, 5),
+            "task": (5, 10, 10),
+            "file": (2, 5, 5),
+            "inventory": (2, 10, 4),
+            "restconf": (5, 5, 2),
+            "default": (5, 10, 10),
+        },
+        # times a call rejected with 429 Too Many Requests is sent again
+        API_RETRIES=5,
+        # seconds before the saved list of devices of a DNAC is updated
+        INVENTORY_TTL=300,
+        # devices per page of the DNAC inventory, and pages fetched at once
+        INVENTORY_PAGE_SIZE=500,
+        INVENTORY_FETCH_WORKERS=4,
+        # backups committed together by the writer, at least every few
+        # seconds, and backups waiting to be written
+        WRITER_BATCH_SIZE=100,
+        WRITER_FLUSH_INTERVAL=2,
+        WRITER_QUEUE_SIZE=1000,
+        # devices listed per page, and versions listed per device before
+        # the rest are loaded on demand
+        DEVICES_PAGE_SIZE=100,
+        VERSIONS_PAGE_SIZE=20,
+        # unchanged lines shown around each change when comparing versions,
+        # and comparisons kept in memory
+        DIFF_CONTEXT=3,
+        DIFF_CACHE_SIZE=32,
+        # parsed configurations kept in memory to compare their sections
+        SECTION_CACHE_SIZE=64,
+        # processes scanning the configurations of a search, none to scan
+        # them in the web app
+        SEARCH_PROCESSES=0,
+        # seconds each run of a backup job may be delayed at random, and
+        # backup jobs of a DNAC run at once
+        JOB_JITTER=60,
+        JOB_DNAC_CONCURRENCY=1,
+        # seconds before the scheduler tries again to read or save a job
+        # after a database error
+        JOB_RETRY_INTERVAL=60,
     )
 
     if test_config is None:
@@ -69,6 +143,11 @@ def create_app(test_config=None):
 
     db.init_app(app)
 
+    # share the configuration with the backup and job services
+    from flaskr import ccc
+
+    ccc.init_app(app)
+
     # apply the blueprints to the app
     from flaskr import auth, devices, dnacs, jobs
 
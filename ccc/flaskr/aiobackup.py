@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Configuration Compliance Check
+
+Copyright (c) 2021 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+
+"""
+
+
+from __future__ import absolute_import, division, print_function
+
+__author__ = "Héctor Cavalcanti Saavedra <hcavalca@cisco.com>"
+__contributors__ = [
+    "Sarah Louise Justin <sajustin@cisco.com>"
+]
+__copyright__ = "Copyright (c) 2021 Cisco and/or its affiliates."
+__license__ = "Cisco Sample Code License, Version 1.1"
+
+
+import asyncio
+import functools
+import json
+import random
+import ssl
+import threading
+import time
+import weakref
+
+import aiohttp
+
+from flaskr.ccc import (BackupError, backup_devices, backup_report,
+                        backup_writer, dnac_session, endpoint_class,
+                        keep_archive, rate_limit, rate_limit_exceeded,
+                        read_archive, retry_after, settings)
+
+
+def ssl_option(verify):
+    '''Returns the ssl argument of aiohttp matching
+    the verify argument of requests.'''
+    if verify is False:
+        return False
+    if isinstance(verify, str):
+        return ssl.create_default_context(cafile=verify)
+    return None
+
+
+# Semaphores of the rate limits on each event loop, which cannot wait
+# on the semaphores of the threads.
+loop_slots = weakref.WeakKeyDictionary()
+loop_slots_lock = threading.Lock()
+
+
+def async_slots(limit):
+    '''Returns the semaphore bounding the calls of a rate
+    limit sent from the running event loop, with the same
+    concurrency as its semaphore for threads.'''
+    loop = asyncio.get_running_loop()
+
+    with loop_slots_lock:
+        slots = loop_slots.setdefault(loop, {})
+        if limit not in slots:
+            slots[limit] = asyncio.Semaphore(limit.concurrency)
+
+        return slots[limit]
+
+
+async def async_throttled(limit, host, endpoint, send):
+    '''Sends a call from the event loop within a rate limit,
+    like ccc.throttled. send is awaited for the status, the
+    headers and the body of each attempt.'''
+    for attempt in range(settings["API_RETRIES"] + 1):
+        async with async_slots(limit):
+            await asyncio.sleep(limit.reserve())
+            status, headers, body = await send()
+
+        if status != 429:
+            return status, headers, body
+        limit.pause(retry_after(headers, attempt))
+
+    raise rate_limit_exceeded(host, endpoint)
+
+
+class AsyncDnac:
+    '''Requests to a DNAC from the event loop, using the
+    token of the DnacSession of the same user.'''
+
+    def __init__(self, dnac, pubkey):
+        self.addr = dnac['addr']
+        self.dnac_sess = dnac_session(dnac['addr'], dnac['dnac_user'], dnac['dnac_pass'], pubkey)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=settings["DNAC_POOL_SIZE"], ssl=ssl_option(pubkey)),
+            headers={'Content-Type': 'application/json'},
+        )
+
+    async def token(self, rejected=None):
+        if rejected is not None or time.monotonic() >= self.dnac_sess.expires:
+            # the token is renewed by the session, under its lock
+            await asyncio.get_running_loop().run_in_executor(
+                None, self.dnac_sess.authenticate, rejected or self.dnac_sess.headers.get('x-auth-token'))
+        
+        return self.dnac_sess.headers['x-auth-token']
+
+    async def request(self, method, url, data=None):
+        '''Returns the headers and the body of the response,
+        sent within the rate limit of its class of API.'''
+        endpoint = endpoint_class(url)
+        limit = rate_limit(self.addr, endpoint)
+
+        async def send(token):
+            async with self.session.request(method, url, data=data, headers={'x-auth-token': token}) as response:
+                return response.status, response.headers, await response.read()
+
+        token = await self.token()
+        status, headers, body = await async_throttled(limit, self.addr, endpoint, functools.partial(send, token))
+        if status == 401:
+            token = await self.token(token)
+            status, headers, body = await async_throttled(limit, self.addr, endpoint, functools.partial(send, token))
+
+        return headers, body
+
+    async def close(self):
+        await self.session.close()
+
+
+async def wait_task(api, task_id, label):
+    '''Returns the file URL of a DNAC task once it is ready,
+    polling it with exponential backoff and jitter.'''
+    url = "https://{}/dna/intent/api/v1/task/{}".format(api.addr, task_id)
+    interval = settings["TASK_POLL_INTERVAL"]
+
+    while True:
+        await asyncio.sleep(random.uniform(interval / 2, interval))
+        headers, body = await api.request("GET", url)
+        task = json.loads(body)['response']
+
+        if task['isError'] == True:
+            raise BackupError("[{}] {}".format(label, task['progress']))
+        elif 'additionalStatusURL' in task:
+            return task['additionalStatusURL']
+        
+        interval = min(interval * 2, settings["TASK_POLL_MAX_INTERVAL"])
+
+
+async def archive_batch(api, dnac, batch, writer, limit):
+    '''Saves the configurations of a batch of devices from
+    a DNAC archive. Returns the errors.'''
+    hostnames = ", ".join(d['hostname'] for d in batch)
+    loop = asyncio.get_running_loop()
+
+    async with limit:
+        url = "https://{}/dna/intent/api/v1/network-device-archive/cleartext".format(dnac['addr'])
+        payload = json.dumps({"deviceId": [d['id'] for d in batch], "password": "W0AUH.nice.key"})
+        headers, body = await api.request("POST", url, data=payload)
+
+        file_url = await wait_task(api, json.loads(body)['response']['taskId'], hostnames)
+
+        url = "https://{}/dna/intent".format(dnac['addr']) + file_url
+        headers, content = await api.request("GET", url)
+
+    # files and archives are handled off the event loop
+    if settings["ARCHIVE_FOLDER"]:
+        await loop.run_in_executor(None, keep_archive, dnac, headers['fileName'], content)
+    
+    return await loop.run_in_executor(None, read_archive, content, batch, writer)
+
+
+async def restconf_backup(restconf, d, writer):
+    url = "https://{}/restconf/data/Cisco-IOS-XE-native:native".format(d['managementIpAddress'])
+    limit = rate_limit(d['managementIpAddress'], "restconf")
+
+    async def send():
+        async with restconf.get(url) as response:
+            return response.status, response.headers, await response.text()
+
+    status, headers, content = await async_throttled(limit, d['managementIpAddress'], "restconf", send)
+    if status == 200:
+        await asyncio.get_running_loop().run_in_executor(None, writer.put, d["device_id"], "RESTCONF", content)
+
+
+async def backup_batch(api, restconf, dnac, batch, writer, limit):
+    try:
+        errors = await archive_batch(api, dnac, batch, writer, limit)
+    except Exception as e:
+        return [str(e) or type(e).__name__]
+
+    if restconf:
+        results = await asyncio.gather(*(restconf_backup(restconf, d, writer) for d in batch), return_exceptions=True)
+        for d, result in zip(batch, results):
+            if isinstance(result, Exception):
+                errors.append("[{}] {}".format(d['hostname'], str(result) or type(result).__name__))
+
+    return errors
+
+
+async def backup_batches(dnac, batches, pubkey, writer):
+    api = AsyncDnac(dnac, pubkey)
+    restconf = None
+
+    if dnac['restconf_user'] and dnac['restconf_pass']:
+        # each device gets its own limit of connections
+        restconf = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=settings["BACKUP_RESTCONF_CONCURRENCY"],
+                limit_per_host=settings["BACKUP_DEVICE_CONCURRENCY"],
+                ssl=ssl_option(pubkey),
+            ),
+            auth=aiohttp.BasicAuth(dnac['restconf_user'], dnac['restconf_pass']),
+            headers={
+                'Content-Type': 'application/yang-data+json',
+                'Accept': 'application/yang-data+json'
+            },
+            # like the timeout of requests, waiting for a connection
+            # of the pool is not counted
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=5, sock_read=5),
+        )
+
+    limit = asyncio.Semaphore(settings["BACKUP_DNAC_CONCURRENCY"])
+
+    try:
+        results = await asyncio.gather(*(backup_batch(api, restconf, dnac, batch, writer, limit) for batch in batches))
+    finally:
+        await api.close()
+        if restconf:
+            await restconf.close()
+
+    return [e for errors in results for e in errors]
+
+
+def backup(dnac, target, pubkey, incremental=False):
+    '''Backs up the devices of a DNAC like ccc.backup, with
+    all the archive tasks and RESTCONF requests in flight
+    on a single event loop, up to the configured limits.'''
+    devices = backup_devices(dnac, target, incremental)
+    if devices is None:
+        return "Errors: [{}] Authentication failed".format(dnac['addr'])
+
+    size = settings["ARCHIVE_BATCH_SIZE"]
+    batches = [devices[i:i+size] for i in range(0, len(devices), size)]
+
+    writer = backup_writer()
+    errors = asyncio.run(backup_batches(dnac, batches, pubkey, writer))
+    errors.extend(writer.flush())
+
+    return backup_report(errors)
@@ -30,151 +30,581 @@ __copyright__ = "Copyright (c) 2021 Cisco and/or its affiliates."
 __license__ = "Cisco Sample Code License, Version 1.1"
 
 
+import bisect
+import collections
 import concurrent.futures
+import datetime
+import email.utils
+import functools
+import heapq
+import io
+import json
+import multiprocessing
 import os
 import queue
+import random
 import sqlite3
+import threading
 import time
-from sqlite3.dbapi2 import Cursor
+import urllib.parse
 
 import pyzipper
 import requests
-import schedule
+import requests.adapters
 from requests.auth import HTTPBasicAuth
 
+from flaskr.db import (ACTIVE_JOBS, BACKUP_DEVICES, BACKUP_UPDATE,
+                       BLOB_CONTENT, BLOB_CONTENTS, CHANGED_DEVICES,
+                       GONE_DEVICES, JOB_NEXT_RUN, JOB_SCHEDULE, JOB_TARGET,
+                       blob_content, connect, decompress, insert_backup,
+                       search_query)
+
+
+# Configuration of the app, shared with the background jobs.
+settings = {}
+
+
+def init_app(app):
+    settings.update(app.config)
+
 
 class BackupError(RuntimeError):
     def __init__(self, *args: object) -> None:
         super().__init__(*args)
 
 
+class AuthError(RuntimeError):
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+
+class RateLimit:
+    '''Token bucket and semaphore limiting a class of calls
+    to a host. A token is reserved for each call, which
+    waits until its token is due.'''
+
+    def __init__(self, rate, burst, concurrency):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.concurrency = concurrency
+        self.slots = threading.BoundedSemaphore(concurrency)
+
+    def refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def reserve(self):
+        '''Takes a token and returns the seconds to wait
+        before the call may be sent.'''
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+            self.tokens -= 1
+            
+            return max(self.updated - now, 0) + max(-self.tokens, 0) / self.rate
+
+    def pause(self, seconds):
+        '''Holds back the calls not sent yet, after the host
+        asked to wait that long. Calls then resume at the
+        rate of the limit.'''
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+            self.tokens = min(self.tokens, 1)
+            self.updated = max(self.updated, now + seconds)
+
+
+# Rate limits shared by every call to the same host and class of API.
+rate_limits = {}
+rate_limits_lock = threading.Lock()
+
+
+def endpoint_class(url):
+    '''Returns the class of API of a URL, by which calls
+    are limited.'''
+    path = urllib.parse.urlsplit(url).path
+    if "/auth/token" in path:
+        return "auth"
+    elif "/network-device-archive/" in path:
+        return "archive"
+    elif "/task/" in path:
+        return "task"
+    elif "/file/" in path:
+        return "file"
+    elif "/network-device" in path:
+        return "inventory"
+    elif path.startswith("/restconf/"):
+        return "restconf"
+    
+    return "default"
+
+
+def rate_limit(host, endpoint):
+    '''Returns the rate limit of a class of API of a host,
+    with the budget configured in API_LIMITS.'''
+    with rate_limits_lock:
+        limit = rate_limits.get((host, endpoint))
+        if limit is None:
+            limits = settings["API_LIMITS"]
+            limit = RateLimit(*limits.get(endpoint, limits["default"]))
+            rate_limits[(host, endpoint)] = limit
+    
+    return limit
+
+
+def retry_after(headers, attempt):
+    '''Returns the seconds to wait asked by a 429 response,
+    or an exponential backoff if it does not say.'''
+    value = headers.get('Retry-After', '')
+    if value.isdigit():
+        return int(value)
+    
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+        return max((when - datetime.datetime.now(datetime.timezone.utc)).total_seconds(), 0)
+    except (TypeError, ValueError):
+        return 2 ** attempt
+
+
+def rate_limit_exceeded(host, endpoint):
+    '''Returns the error of a call still rejected with 429
+    after all its retries.'''
+    return BackupError("[{}] Rate limit of the {} API still exceeded after {} retries".format(host, endpoint, settings["API_RETRIES"]))
+
+
+def throttled(url, send):
+    '''Sends a call within the rate limit of its host and
+    class of API. A call rejected with 429 holds back the
+    calls of the same limit as long as asked, and is sent
+    again up to API_RETRIES times.'''
+    endpoint = endpoint_class(url)
+    host = urllib.parse.urlsplit(url).netloc
+    limit = rate_limit(host, endpoint)
+
+    for attempt in range(settings["API_RETRIES"] + 1):
+        with limit.slots:
+            time.sleep(limit.reserve())
+            response = send()
+        
+        if response.status_code != 429:
+            return response
+        limit.pause(retry_after(response.headers, attempt))
+    
+    raise rate_limit_exceeded(host, endpoint)
+
+
+class ThrottledSession(requests.Session):
+    '''Session whose calls are sent within the rate limits
+    of the host they are sent to.'''
+
+    def request(self, method, url, *args, **kwargs):
+        return throttled(url, functools.partial(super().request, method, url, *args, **kwargs))
+
+
+class DnacSession(ThrottledSession):
+    '''Session authenticated to a DNAC with a token, which
+    is requested again when it expires or is rejected.'''
+
+    def __init__(self, addr, user, password, verify):
+        super().__init__()
+        self.addr = addr
+        self.user = user
+        self.password = password
+        self.verify = verify
+        self.headers.update({'Content-Type': 'application/json'})
+        self.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=settings["DNAC_POOL_SIZE"]))
+        self.expires = 0
+        self.lock = threading.Lock()
+
+    def authenticate(self, rejected=None):
+        with self.lock:
+            # another thread may have renewed the token meanwhile
+            if rejected is not None and rejected != self.headers.get('x-auth-token'):
+                return
+            
+            url = "https://{}/dna/system/api/v1/auth/token".format(self.addr)
+            response = super().request("POST", url, auth=HTTPBasicAuth(self.user, self.password), data={})
+
+            if response.status_code != 200 or 'Token' not in response.json():
+                raise AuthError("[{}] Authentication failed: {}".format(self.addr, response.text))
+
+            self.headers.update({'x-auth-token': response.json()['Token']})
+            self.expires = time.monotonic() + settings["DNAC_TOKEN_LIFETIME"]
+
+    def request(self, method, url, *args, **kwargs):
+        if time.monotonic() >= self.expires:
+            self.authenticate(self.headers.get('x-auth-token'))
+        
+        token = self.headers.get('x-auth-token')
+        response = super().request(method, url, *args, **kwargs)
+        if response.status_code == 401:
+            self.authenticate(token)
+            response = super().request(method, url, *args, **kwargs)
+        
+        return response
+
+
+# DNAC sessions shared by the web app and the background jobs.
+dnac_sessions = {}
+dnac_sessions_lock = threading.Lock()
+
+
+def dnac_session(addr, user, password, verify=False):
+    '''Returns the session of a DNAC user, which keeps its
+    token and its HTTPS connections between calls.'''
+    with dnac_sessions_lock:
+        dnac_sess = dnac_sessions.get((addr, user))
+        if dnac_sess is None or dnac_sess.password != password or dnac_sess.verify != verify:
+            dnac_sess = DnacSession(addr, user, password, verify)
+            dnac_sessions[(addr, user)] = dnac_sess
+    
+    return dnac_sess
+
+
+class TaskPoller:
+    '''Polls all the outstanding tasks of a DNAC from a
+    single thread. Each task is polled with exponential
+    backoff and jitter, and the future returned by watch
+    is resolved with its file URL once it is ready.'''
+
+    def __init__(self, dnac, dnac_sess):
+        self.url = "https://{}/dna/intent/api/v1/task/".format(dnac['addr'])
+        self.dnac_sess = dnac_sess
+        self.interval = settings["TASK_POLL_INTERVAL"]
+        self.max_interval = settings["TASK_POLL_MAX_INTERVAL"]
+        self.due = []
+        self.tasks = {}
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def watch(self, task_id, label):
+        future = concurrent.futures.Future()
+        with self.condition:
+            self.tasks[task_id] = (future, label, self.interval)
+            heapq.heappush(self.due, (time.monotonic() + self.interval, task_id))
+            self.condition.notify()
+        return future
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.closed and (not self.due or self.due[0][0] > time.monotonic()):
+                    self.condition.wait(self.due[0][0] - time.monotonic() if self.due else None)
+                if self.closed:
+                    return
+                due, task_id = heapq.heappop(self.due)
+                future, label, interval = self.tasks.pop(task_id)
+
+            try:
+                # a poll that hangs only fails its own task
+                task = self.dnac_sess.request("GET", self.url + task_id, data={}, timeout=self.max_interval).json()['response']
+                print(task['progress']+" => {}".format(task['isError']))
+            except Exception as e:
+                future.set_exception(e)
+                continue
+
+            if task['isError'] == True:
+                future.set_exception(BackupError("[{}] {}".format(label, task['progress'])))
+            elif 'additionalStatusURL' in task:
+                future.set_result(task['additionalStatusURL'])
+            else:
+                interval = min(interval * 2, self.max_interval)
+                with self.condition:
+                    self.tasks[task_id] = (future, label, interval)
+                    heapq.heappush(self.due, (time.monotonic() + random.uniform(interval / 2, interval), task_id))
+
+
+class BackupWriter:
+    '''Saves the backups taken by all the workers from a
+    single connection, so that they never compete for
+    the write lock. Backups are committed in batches, at
+    most every few seconds, along with the last update of
+    the devices they were taken at.'''
+
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=settings["WRITER_QUEUE_SIZE"])
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        pending = []
+        deadline = None
+
+        while True:
+            try:
+                item = self.queue.get(timeout=None if deadline is None else max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                item = None
+
+            if isinstance(item, tuple):
+                pending.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + settings["WRITER_FLUSH_INTERVAL"]
+                if len(pending) < settings["WRITER_BATCH_SIZE"]:
+                    continue
+
+            try:
+                if pending:
+                    self.save(pending)
+            except Exception as e:
+                print("The backup writer failed: {}".format(e))
+            finally:
+                # the runs waiting for a flush never wait forever
+                pending = []
+                deadline = None
+                if isinstance(item, threading.Event):
+                    item.set()
+
+    def save(self, pending):
+        '''Commits a batch of backups. Each backup is saved
+        in its own savepoint, so that one that fails does not
+        discard the others, and its error goes to its run.
+        If the batch cannot be committed, every run of the
+        batch gets the error.'''
+        db = None
+
+        try:
+            db = connect()
+            db.execute("BEGIN")
+            for device_id, config_type, content, last_update, errors in pending:
+                db.execute("SAVEPOINT backup")
+                try:
+                    insert_backup(db, device_id, config_type, content)
+                    if last_update is not None:
+                        db.execute(BACKUP_UPDATE, (last_update, device_id))
+                except Exception as e:
+                    db.execute("ROLLBACK TO backup")
+                    errors.append("Could not save the {} backup of device {}: {}".format(config_type, device_id, e))
+                db.execute("RELEASE backup")
+            db.commit()
+        except Exception as e:
+            for device_id, config_type, content, last_update, errors in pending:
+                errors.append("Could not save the {} backup of device {}: {}".format(config_type, device_id, e))
+            if db is not None:
+                db.rollback()
+
+
+class WriterChannel:
+    '''Queues the backups of a single run to the shared
+    writer, and collects the errors met saving them.'''
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.errors = []
+
+    def put(self, device_id, config_type, content, last_update=None):
+        self.writer.queue.put((device_id, config_type, content, last_update, self.errors))
+
+    def flush(self):
+        '''Waits until the backups put so far are committed,
+        and returns the errors met since the last flush.'''
+        flushed = threading.Event()
+        self.writer.queue.put(flushed)
+        flushed.wait()
+
+        errors, self.errors = self.errors, []
+        return errors
+
+
+# Writer shared by all the backup runs.
+writer = None
+writer_lock = threading.Lock()
+
+
+def backup_writer():
+    '''Returns a channel of a new backup run to the shared
+    writer, started the first time.'''
+    global writer
+
+    with writer_lock:
+        if writer is None:
+            writer = BackupWriter()
+    
+    return WriterChannel(writer)
+
+
 def producer(queue, products):
     for p in products:
         queue.put(p)
 
 
-def backup_cons(queue, dnac, dnac_sess, restconf_sess):
+def archive_owner(filename, devices):
+    '''Returns the device of a batch that an archive
+    entry belongs to, or None if there is no such device.'''
+    if len(devices) == 1:
+        return devices[0]
+
+    # The longest identifier wins, so that an entry of
+    # 10.0.0.10 is not given to the device at 10.0.0.1.
+    owner = None
+    length = 0
+    for d in devices:
+        for key in (d['id'], d['hostname'], d['managementIpAddress']):
+            if key and key in filename and len(key) > length:
+                owner = d
+                length = len(key)
+    
+    return owner
+
+
+def keep_archive(dnac, filename, content):
+    '''Saves a raw archive downloaded from a DNAC in the
+    folder of the DNAC under ARCHIVE_FOLDER.'''
+    folder = os.path.join(settings["ARCHIVE_FOLDER"], str(dnac['id']))
+    os.makedirs(folder, exist_ok=True)
+
+    with open(os.path.join(folder, os.path.basename(filename)), 'wb') as archive:
+        archive.write(content)
+
+
+def read_archive(content, batch, writer):
+    '''Saves the configurations of a batch of devices from
+    an archive downloaded from a DNAC. Returns the errors.'''
+    hostnames = ", ".join(d['hostname'] for d in batch)
+    archived = set()
+    errors = []
+
+    # the archive is read from memory, each entry is decrypted
+    # and decoded once
+    with pyzipper.AESZipFile(io.BytesIO(content)) as zf:
+        zf.setpassword(b'W0AUH.nice.key')
+        for f in zf.infolist():
+            if 'STARTUP' in f.filename:
+                config_type = "CLI Startup"
+            elif 'RUNNING' in f.filename:
+                config_type = "CLI Running"
+            else:
+                continue
+
+            d = archive_owner(f.filename, batch)
+            if d is None:
+                errors.append("[{}] No device for archive entry {}".format(hostnames, f.filename))
+                continue
+
+            writer.put(d["device_id"], config_type, zf.read(f).decode('ascii'), d["last_update"])
+            archived.add(d["id"])
+
+    for d in batch:
+        if d["id"] not in archived:
+            errors.append("[{}] No configuration in archive".format(d['hostname']))
+
+    return errors
+
+
+def backup_cons(queue, dnac, dnac_sess, restconf_sess, poller, writer):
     errors = []
     
     while True:
-        d = queue.get()
-        if d == "END":
+        batch = queue.get()
+        if batch == "END":
             return errors
 
-        folder = "Backups/{}/{}/".format(dnac['id'], d['id'])
+        hostnames = ", ".join(d['hostname'] for d in batch)
 
         try:
             url = "https://{}/dna/intent/api/v1/network-device-archive/cleartext".format(dnac['addr'])
-            payload='{"deviceId": ["'+d['id']+'"], "password": "W0AUH.nice.key"}'
+            payload=json.dumps({"deviceId": [d['id'] for d in batch], "password": "W0AUH.nice.key"})
 
             response = dnac_sess.request("POST", url, data=payload)
 
-            url = "https://{}/dna/intent/api/v1/task/".format(dnac['addr']) + response.json()['response']['taskId']
+            # the poller wakes this worker up once the archive is ready
+            file_url = poller.watch(response.json()['response']['taskId'], hostnames).result()
             payload={}
-
-            file_url = ''
-            while file_url == '':
-                response = dnac_sess.request("GET", url, data=payload)
-
-                print(response.json()['response']['progress']+" => {}".format(response.json()['response']['isError']))
-
-                if response.json()['response']['isError'] == True:
-                    raise BackupError("[{}] {}".format(d['hostname'], response.json()['response']['progress']))
-                
-                if 'additionalStatusURL' in response.json()['response']:
-                    file_url = response.json()['response']['additionalStatusURL']
-                
-                time.sleep(1)
             
             url = "https://{}/dna/intent".format(dnac['addr']) + file_url
 
             response = dnac_sess.request("GET", url, data=payload)
 
-            try:
-                os.makedirs(folder)
-            except:
-                print('Folder already created.')
+            if settings["ARCHIVE_FOLDER"]:
+                keep_archive(dnac, response.headers['fileName'], response.content)
             
-            with open(os.path.join(folder, response.headers['fileName']), 'wb') as backup_file:
-                print('Saving native config...')
-                backup_file.write(response.content)
-            
-            db = sqlite3.connect(
-                "instance/flaskr.sqlite", detect_types=sqlite3.PARSE_DECLTYPES
-            )
-            db.row_factory = sqlite3.Row
-            
-            device = db.execute(
-                "SELECT *"
-                " FROM device"
-                " WHERE dnac_id = ? AND uuid = ?",
-                (dnac["id"],d["id"]),
-            ).fetchone()
-
-            with pyzipper.AESZipFile(os.path.join(folder, response.headers['fileName'])) as zf:
-                zf.setpassword(b'W0AUH.nice.key')
-                files = zf.infolist()
-                for f in files:
-                    if 'STARTUP' in f.filename:
-                        db.execute(
-                            "INSERT INTO backup (device_id, config_type, content) VALUES (?, ?, ?)",
-                            (device["id"], "CLI Startup", zf.read(f.filename).decode('ascii')),
-                        )
-                    elif 'RUNNING' in f.filename:
-                        db.execute(
-                            "INSERT INTO backup (device_id, config_type, content) VALUES (?, ?, ?)",
-                            (device["id"], "CLI Running", zf.read(f.filename).decode('ascii')),
-                        )
+            errors.extend(read_archive(response.content, batch, writer))
 
-            db.commit()
-            db.close()
-
-            if os.path.exists(os.path.join(folder, response.headers['fileName'])):
-                os.remove(os.path.join(folder, response.headers['fileName']))
-
-            if restconf_sess:
-                url = "https://{}/restconf/data/Cisco-IOS-XE-native:native".format(d['managementIpAddress'])
-
-                response = restconf_sess.request("GET", url, data=payload, timeout=5)
-
-                # print(response.text)
-
-                if response.status_code == 200:
-                    db = sqlite3.connect(
-                        "instance/flaskr.sqlite", detect_types=sqlite3.PARSE_DECLTYPES
-                    )
-                    db.row_factory = sqlite3.Row
-                    db.execute(
-                        "INSERT INTO backup (device_id, config_type, content) VALUES (?, ?, ?)",
-                        (device["id"], "RESTCONF", response.text),
-                    )
-                    db.commit()
-                    db.close()
-                else:
-                    url = "https://{}/restconf/data/netconf-state/capabilities".format(d['managementIpAddress'])
-                    response = restconf_sess.request("GET", url, data=payload, timeout=5)
-                    print(response.text)
-            
         except BackupError as e:
             errors.append(e.args[0])
+            continue
         except Exception as e:
             errors.append(e.args[0])
+            continue
 
+        if restconf_sess:
+            for d in batch:
+                try:
+                    restconf_backup(d, restconf_sess, writer)
+                except Exception as e:
+                    errors.append(e.args[0])
 
-def backup(dnac, target, pubkey):
-    processes = []
+
+def restconf_backup(d, restconf_sess, writer):
+    payload={}
+    url = "https://{}/restconf/data/Cisco-IOS-XE-native:native".format(d['managementIpAddress'])
+
+    response = restconf_sess.request("GET", url, data=payload, timeout=5)
+
+    # print(response.text)
+
+    if response.status_code == 200:
+        writer.put(d["device_id"], "RESTCONF", response.text)
+    else:
+        url = "https://{}/restconf/data/netconf-state/capabilities".format(d['managementIpAddress'])
+        response = restconf_sess.request("GET", url, data=payload, timeout=5)
+        print(response.text)
+
+
+def backup_devices(dnac, target, incremental=False):
+    '''Returns the connected devices of a DNAC to back up,
+    all of them if target is True, or None if the list of
+    devices could not be updated. An incremental backup
+    leaves out the devices unchanged since their last
+    backup, unless it is older than a full sweep.'''
+    if update_devices(dnac, dnac) is None:
+        return None
+
+    db = connect()
+
+    if incremental:
+        # a failed backup leaves the update of the previous one, and devices
+        # without an update from their DNAC are always backed up
+        all_devs = db.execute(
+            CHANGED_DEVICES, (dnac['id'], "-{:d} seconds".format(settings["BACKUP_FULL_SWEEP"]))
+        ).fetchall()
+    else:
+        all_devs = db.execute(BACKUP_DEVICES, (dnac['id'],)).fetchall()
+
+    if target == True:
+        return all_devs
     
-    dnac_sess = requests.Session()
-    restconf_sess = None
+    return [d for d in all_devs if d['id'] in target]
 
-    url = "https://{}/dna/system/api/v1/auth/token".format(dnac['addr'])
 
-    payload={}
-    dnac_sess.headers.update({'Content-Type': 'application/json'})
-    dnac_sess.verify=pubkey
+def backup(dnac, target, pubkey, incremental=False):
+    if settings["BACKUP_ENGINE"] == "asyncio":
+        # aiohttp is only needed by the asyncio engine
+        try:
+            from flaskr.aiobackup import backup as async_backup
+        except ImportError as e:
+            return "Errors: The asyncio backup engine requires aiohttp: {}".format(e)
+        return async_backup(dnac, target, pubkey, incremental)
+
+    processes = []
+    
+    dnac_sess = dnac_session(dnac['addr'], dnac['dnac_user'], dnac['dnac_pass'], pubkey)
+    restconf_sess = None
 
     if dnac['restconf_user'] and dnac['restconf_pass']:
-        restconf_sess = requests.Session()
+        restconf_sess = ThrottledSession()
 
         restconf_sess.headers.update({
             'Content-Type': 'application/yang-data+json',
@@ -183,209 +613,425 @@ def backup(dnac, target, pubkey):
         restconf_sess.verify=pubkey
         restconf_sess.auth=HTTPBasicAuth(dnac['restconf_user'], dnac['restconf_pass'])
 
-    response = dnac_sess.request("POST", url, auth=HTTPBasicAuth(dnac['dnac_user'], dnac['dnac_pass']), data=payload)
-
-    # print(response.text)
-
-    dna_token = response.json()['Token']
-    dnac_sess.headers.update({'Content-Type': 'application/json', 'x-auth-token': dna_token})
-    
-    # print(response.text)
-
-    devices = []
-    all_devs = update_devices(dnac, dnac)
-    if target == True:
-        devices = all_devs
-    else:
-        for d in all_devs:
-            if d['id'] in target:
-                devices.append(d)
+    devices = backup_devices(dnac, target, incremental)
+    if devices is None:
+        return "Errors: [{}] Authentication failed".format(dnac['addr'])
 
     # print(devices)
 
+    # Devices are archived in batches, each with a single DNAC task.
+    size = settings["ARCHIVE_BATCH_SIZE"]
+    batches = [devices[i:i+size] for i in range(0, len(devices), size)]
+
     pipeline = queue.Queue(maxsize=10)
 
-    errors = "Errors: "
+    errors = []
+
+    poller = TaskPoller(dnac, dnac_sess)
+    writer = backup_writer()
 
     with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
         for i in range(9):
-            devices.append("END")
-            processes.append(executor.submit(backup_cons, pipeline, dnac, dnac_sess, restconf_sess))
-        executor.submit(producer, pipeline, devices)
+            batches.append("END")
+            processes.append(executor.submit(backup_cons, pipeline, dnac, dnac_sess, restconf_sess, poller, writer))
+        executor.submit(producer, pipeline, batches)
 
         for p in concurrent.futures.as_completed(processes):
-            for e in p.result():
-                errors += "{}, ".format(e)
+            errors.extend(p.result())
+    
+    poller.close()
+    errors.extend(writer.flush())
         
-    if errors == "Errors: ":
-        return "Backup operation completed successfully!"
-    else:
-        return errors
+    return backup_report(errors)
 
 
-def findall(p, s):
-    '''Yields all the positions of
-    the pattern p in the string s.'''
-    p = p.upper()
-    s = s.upper()
+def backup_report(errors):
+    '''Returns the outcome of a backup shown to the user.'''
+    if not errors:
+        return "Backup operation completed successfully!"
     
-    i = s.find(p)
-    while i != -1:
-        yield i
-        i = s.find(p, i+1)
+    return "Errors: " + "".join("{}, ".format(e) for e in errors)
+
+
+def snippet(content, match, width=128):
+    '''Returns the context of a match in content,
+    with up to width characters on each side.'''
+    start, end = match
+    return {
+        "match": match,
+        "before": ("..." if start > width else "") + content[max(start - width, 0):start],
+        "text": content[start:end],
+        "after": content[end:end + width] + ("..." if end + width < len(content) else ""),
+    }
+
+
+def search(selection, config_type, pattern, dnac, cache_size=64):
+    '''Yields the backups of a DNAC matching the pattern, in
+    hostname order, along with the context of each match.
+    Only the configurations that have to be scanned are kept
+    in memory, so results can be streamed as they are found.'''
+    scanned = collections.OrderedDict()
+
+    # The trigram index narrows the scan down to the configurations
+    # that may match the pattern.
+    expression = pattern.expression
+    params = (dnac,) if expression is None else (dnac, expression)
+
+    db = connect()
+    rows = db.execute(search_query(selection, config_type, expression is not None), params)
+    if settings["SEARCH_PROCESSES"]:
+        yield from search_processes(rows.fetchall(), pattern)
+        return
+
+    for b in rows:
+        # Versions of a device mostly share the same configuration,
+        # so each one is only fetched and scanned once in a row.
+        if b['blob_id'] in scanned:
+            scanned.move_to_end(b['blob_id'])
+        else:
+            blob = db.execute(BLOB_CONTENT, (b['blob_id'],)).fetchone()
+            content = blob_content(blob)
+            scanned[b['blob_id']] = [snippet(content, m) for m in pattern.scan(content)]
+            if len(scanned) > cache_size:
+                scanned.popitem(last=False)
 
+        if scanned[b['blob_id']]:
+            yield b, scanned[b['blob_id']]
 
-def search_cons(queue, query):
-    results = []
 
-    while True:
-        b = queue.get()
-        if b == "END":
-            return results
+# Processes scanning configurations for the searches.
+search_pool = None
+search_pool_lock = threading.Lock()
 
-        # matches = list(re.finditer(re.escape(query), b['content']))
-        matches = [(i, i+len(query)) for i in findall(query, b['content'])]
-        if matches:
-            results.append((b, matches))
 
+def search_executor():
+    '''Returns the pool of processes of the searches,
+    started on first use.'''
+    global search_pool
 
-def search(selection, config_type, query, dnac):
-    pipeline = queue.Queue(maxsize=10)
-    results = []
-    processes = []
-    filter = "config_type <> 'RESTCONF'"
-    backups = Cursor
-
-    if config_type == "running":
-        filter = "config_type = 'CLI Running'"
-    elif config_type == "startup":
-        filter = "config_type = 'CLI Startup'"
-
-    db = sqlite3.connect(
-        "instance/flaskr.sqlite", detect_types=sqlite3.PARSE_DECLTYPES
-    )
-    db.row_factory = sqlite3.Row
-    if selection == 'all':
-        backups = db.execute(
-            "SELECT b.id, device_id, created, config_type, content, dnac_id, uuid, hostname"
-            " FROM backup b JOIN device d ON b.device_id = d.id"
-            " WHERE dnac_id = ? AND {}".format(filter),
-            (dnac,),
-        ).fetchall()
-    else:
-        backups = db.execute(
-            "SELECT b.id, device_id, MAX(created) AS created, config_type, content, dnac_id, uuid, hostname"
-            " FROM backup b JOIN device d ON b.device_id = d.id"
-            " WHERE dnac_id = ? AND {}"
-            " GROUP BY device_id".format(filter),
-            (dnac,),
-        ).fetchall()
-    db.close()
-
-    with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-        for i in range(4):
-            backups.append("END")
-            processes.append(executor.submit(search_cons, pipeline, query))
-        executor.submit(producer, pipeline, backups)
-        
-        for p in concurrent.futures.as_completed(processes):
-            results.extend(p.result())
+    with search_pool_lock:
+        if search_pool is None:
+            # forking would copy the threads of the app
+            search_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=settings["SEARCH_PROCESSES"],
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+    
+    return search_pool
+
+
+def scan_blobs(database, ids, pattern):
+    '''Returns the context of each match of the pattern
+    in the given blobs, by blob id. Run by the processes
+    of the searches, which read the blobs themselves.'''
+    db = sqlite3.connect(database)
+    found = {}
+
+    try:
+        for blob_id, content, compression in db.execute(BLOB_CONTENTS, (json.dumps(ids),)):
+            content = decompress(content, compression)
+            matches = pattern.scan(content)
+            if matches:
+                found[blob_id] = [snippet(content, m) for m in matches]
+    finally:
+        db.close()
+
+    return found
+
+
+def search_processes(rows, pattern):
+    '''Yields the rows of a search matching the pattern, in
+    their order, along with the context of each match. The
+    blobs are split by id range between the processes of
+    the searches, so only the matches are sent back.'''
+    ids = sorted({b['blob_id'] for b in rows})
+    if not ids:
+        return
+
+    # A few ranges per process, so that they all keep busy until
+    # the end even if some ranges take longer to scan.
+    count = settings["SEARCH_PROCESSES"] * 4
+    size = -(-len(ids) // count)
+    ranges = [ids[i:i+size] for i in range(0, len(ids), size)]
+    starts = [r[0] for r in ranges]
+
+    executor = search_executor()
+    futures = [executor.submit(scan_blobs, settings["DATABASE"], r, pattern) for r in ranges]
+
+    try:
+        for b in rows:
+            found = futures[bisect.bisect_right(starts, b['blob_id']) - 1].result()
+            if b['blob_id'] in found:
+                yield b, found[b['blob_id']]
+    finally:
+        for f in futures:
+            f.cancel()
+
+
+def fetch_devices(dnac_sess, addr):
+    '''Yields all the devices of a DNAC, page by page.
+    A few pages are fetched ahead concurrently while
+    the previous ones are consumed.'''
+    url = "https://{}/dna/intent/api/v1/network-device".format(addr)
+    limit = settings["INVENTORY_PAGE_SIZE"]
+    workers = settings["INVENTORY_FETCH_WORKERS"]
+
+    def fetch(offset):
+        return dnac_sess.request("GET", url, params={"offset": offset, "limit": limit}, data={}).json()['response']
+
+    count = dnac_sess.request("GET", url + "/count", data={}).json()['response']
+
+    offsets = range(1, count + 1, limit)
+    page = []
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pages = collections.deque()
+        for offset in offsets:
+            pages.append(executor.submit(fetch, offset))
+            if len(pages) >= workers:
+                page = pages.popleft().result()
+                yield from page
+        while pages:
+            page = pages.popleft().result()
+            yield from page
     
-    results.sort(key=lambda x: x[0]['hostname'])
-    return results
+    # devices added since they were counted come after the last page
+    offset = offsets[-1] + limit if offsets else 1
+    while len(page) == limit:
+        page = fetch(offset)
+        yield from page
+        offset += limit
 
 
 def update_devices(dnac, user_dnac):
-    dnac_sess = requests.Session()
+    '''Saves the devices of a DNAC, and marks the ones it
+    no longer has as disconnected. Returns the number of
+    devices, or None if the DNAC could not be reached.'''
+    dnac_sess = dnac_session(dnac["addr"], user_dnac["dnac_user"], user_dnac["dnac_pass"])
+
+    db = connect()
+
+    try:
+        # Devices are upserted in bulk, and marked with the time of this
+        # update so the ones that are gone can be found in a single pass.
+        # The time is kept after the one of the previous update, so that
+        # two updates never share it.
+        synced = db.execute(
+            "SELECT strftime('%Y-%m-%d %H:%M:%f', max(julianday('now'), coalesce(julianday(synced, '+0.001 seconds'), 0)))"
+            " FROM dnac WHERE id = ?",
+            (dnac['id'],),
+        ).fetchone()[0]
+
+        # All the pages are fetched before the first write, so that the
+        # write lock is not held while waiting for the DNAC. Only the
+        # columns saved are kept from each device.
+        devices = [
+            (dnac['id'], d["id"], d["hostname"], d["managementIpAddress"], synced, d.get("lastUpdateTime"))
+            for d in fetch_devices(dnac_sess, dnac["addr"])
+        ]
+
+        cursor = db.executemany(
+            "INSERT INTO device (dnac_id, uuid, hostname, addr, synced, last_update) VALUES (?, ?, ?, ?, ?, ?)"
+            " ON CONFLICT (dnac_id, uuid) DO UPDATE"
+            " SET hostname = excluded.hostname, addr = excluded.addr, connected = 1, synced = excluded.synced,"
+            " last_update = excluded.last_update",
+            devices,
+        )
+        db.execute(GONE_DEVICES, (dnac['id'], synced))
+        db.execute(
+            "UPDATE dnac SET synced = ? WHERE id = ?", (synced, dnac['id'])
+        )
+        db.commit()
+    except AuthError as e:
+        db.rollback()
+        print(e.args[0])
+        return None
+    except Exception:
+        db.rollback()
+        raise
 
-    url = "https://{}/dna/system/api/v1/auth/token".format(dnac["addr"])
-    
-    payload={}
-    dnac_sess.headers.update({'Content-Type': 'application/json'})
-    dnac_sess.verify=False
+    return cursor.rowcount
 
-    response = dnac_sess.request("POST", url, auth=HTTPBasicAuth(user_dnac["dnac_user"], user_dnac["dnac_pass"]), data=payload)
 
-    print(response.text)
+# DNACs whose devices are being updated in the background.
+refreshing = set()
+refreshing_lock = threading.Lock()
 
-    if 'Token' not in response.json():
-        return None
 
-    dna_token = response.json()['Token']
+def refresh_devices(dnac, user_dnac):
+    '''Updates the devices of a DNAC in the background,
+    unless they are already being updated. Returns
+    whether a new update was started.'''
+    with refreshing_lock:
+        if dnac['id'] in refreshing:
+            return False
+        refreshing.add(dnac['id'])
 
-    url = "https://{}/dna/intent/api/v1/network-device".format(dnac["addr"])
-    
-    dnac_sess.headers.update({'Content-Type': 'application/json', 'x-auth-token': dna_token})
-    
-    response = dnac_sess.request("GET", url, data=payload)
+    def refresh():
+        try:
+            update_devices(dnac, user_dnac)
+        except Exception as e:
+            print("[{}] Device update failed: {}".format(dnac['addr'], e))
+        finally:
+            with refreshing_lock:
+                refreshing.discard(dnac['id'])
 
-    devices = response.json()['response']
-    
-    db = sqlite3.connect(
-        "instance/flaskr.sqlite", detect_types=sqlite3.PARSE_DECLTYPES
-    )
-    db.row_factory = sqlite3.Row
+    threading.Thread(target=refresh, daemon=True).start()
+    return True
 
-    db.execute(
-        "UPDATE device SET connected = 0 WHERE dnac_id = ?", (dnac['id'],)
-    )
 
-    for d in devices:
-        exists = db.execute(
-            "SELECT *"
-            " FROM device"
-            " WHERE dnac_id = ? AND uuid = ?",
-            (dnac['id'],d["id"]),
-        ).fetchone()
-        if exists is None:
-            db.execute(
-                "INSERT INTO device (dnac_id, uuid, hostname, addr) VALUES (?, ?, ?, ?)",
-                (dnac['id'], d["id"], d["hostname"], d["managementIpAddress"]),
-            )
-        else:
-            db.execute(
-                "UPDATE device SET hostname = ?, addr = ?, connected = 1 WHERE id = ?", (d["hostname"], d["managementIpAddress"], exists["id"])
-            )
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def utcnow():
+    '''Returns the current time like CURRENT_TIMESTAMP.'''
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None, microsecond=0)
+
+
+def first_run(job_id, frequency, now):
+    '''Returns the first run of a job after now. Jobs run
+    every frequency minutes at their own phase, so jobs of
+    the same frequency do not all start at once.'''
+    period = frequency * 60
+    # consecutive ids get phases spread over the whole period
+    phase = int((job_id * 0.6180339887498949) % 1 * period)
+    elapsed = int((now - EPOCH).total_seconds()) - phase
     
-    db.commit()
-    db.close()
+    return EPOCH + datetime.timedelta(seconds=phase + period * (elapsed // period + 1))
 
-    return devices
+
+def next_run(last, frequency, now):
+    '''Returns the first run of a job after now, every
+    frequency minutes from its last run. The runs missed
+    meanwhile are skipped.'''
+    period = datetime.timedelta(minutes=frequency)
+    if last > now:
+        return last
+    
+    return last + period * ((now - last) // period + 1)
 
 
 def job_prod(jobqueue, actionqueue):
-    db = sqlite3.connect(
-        "instance/flaskr.sqlite", detect_types=sqlite3.PARSE_DECLTYPES
-    )
-    db.row_factory = sqlite3.Row
-    jobs = db.execute(
-        "SELECT j.id, author_id, j.dnac_id, addr, dnac_user, dnac_pass, restconf_user, restconf_pass, created, title, frequency, activated"
-        " FROM job j JOIN user_dnac ud ON j.author_id = ud.user_id AND j.dnac_id = ud.dnac_id"
-        " JOIN dnac d ON j.dnac_id = d.id",
-    ).fetchall()
-    db.close()
+    '''Puts the backup jobs in the queue when they are due.
+    Jobs are kept in a heap by their next run, which is saved
+    with each job so the schedule survives a restart, and the
+    thread sleeps until a job is due or an action arrives.
+    A job or action met with a database error is tried again
+    later, so the scheduler never stops.'''
+    db = connect()
+    due = []
+    # next run of each job, heap entries of older runs are stale
+    scheduled = {}
+    retry = datetime.timedelta(seconds=settings["JOB_RETRY_INTERVAL"])
+
+    def plan(job_id, run):
+        # each run is delayed a little, without moving the schedule
+        scheduled[job_id] = run
+        heapq.heappush(due, (run + datetime.timedelta(seconds=random.uniform(0, settings["JOB_JITTER"])), run, job_id))
+
+    # jobs missed while the app was down are run right away
+    while True:
+        try:
+            jobs = db.execute(ACTIVE_JOBS).fetchall()
+            break
+        except Exception as e:
+            print("Could not read the backup jobs: {}".format(e))
+            time.sleep(retry.total_seconds())
 
     for j in jobs:
-        schedule.every(j['frequency']).minutes.do(jobqueue.put, [j['activated'], j, True, False]).tag(j['id'])
+        plan(j['id'], j['next_run'] or first_run(j['id'], j['frequency'], utcnow()))
     
     while True:
-        schedule.run_pending()
-        time.sleep(1)
-        # print("Job service active! => {}".format(threading.get_ident()))
-        if not actionqueue.empty():
-            a = actionqueue.get()
-            print(a)
-            if a['action'] in ["update", "delete"]:
-                schedule.clear(a['job'])
-            if a['action'] in ["create", "update"]:
-                schedule.every(a['frequency']).minutes.do(jobqueue.put, [a['activated'], a['dnac'], True, False]).tag(a['job'])
+        timeout = None
+        if due:
+            timeout = max((due[0][0] - utcnow()).total_seconds(), 0)
+        
+        try:
+            a = actionqueue.get(timeout=timeout)
+        except queue.Empty:
+            pass
+        else:
+            # the job is planned again as it was saved by the action
+            try:
+                job = db.execute(JOB_SCHEDULE, (a['job'],)).fetchone()
+            except Exception as e:
+                print("Could not reschedule backup job {}: {}".format(a['job'], e))
+                threading.Timer(retry.total_seconds(), actionqueue.put, (a,)).start()
+                continue
+
+            scheduled.pop(a['job'], None)
+            if job is not None and job['activated']:
+                plan(job['id'], job['next_run'] or first_run(job['id'], job['frequency'], utcnow()))
+            continue
+
+        now = utcnow()
+        while due and due[0][0] <= now:
+            _, run, job_id = heapq.heappop(due)
+            if scheduled.get(job_id) != run:
+                continue
+
+            # the DNAC is read when the job runs, with its latest credentials,
+            # and the next run is saved before the job is queued
+            try:
+                job = db.execute(JOB_TARGET, (job_id,)).fetchone()
+                if job is None:
+                    del scheduled[job_id]
+                    continue
+
+                after = next_run(run, job['frequency'], now)
+                db.execute(JOB_NEXT_RUN, (after.strftime("%Y-%m-%d %H:%M:%S"), job_id))
+                db.commit()
+            except Exception as e:
+                db.rollback()
+                print("Could not run backup job {}: {}".format(job_id, e))
+                heapq.heappush(due, (now + retry, run, job_id))
+                continue
+
+            jobqueue.put([True, job, True, False, job_id])
+            plan(job_id, after)
+
+
+# Backup jobs running for each DNAC, and those waiting for them, with
+# the ids of all these jobs.
+running_jobs = collections.Counter()
+waiting_jobs = collections.defaultdict(collections.deque)
+pending_jobs = set()
+jobs_lock = threading.Lock()
 
 
 def job_cons(jobqueue):
+    '''Runs the backup jobs, at most JOB_DNAC_CONCURRENCY at
+    once for each DNAC. The jobs of a busy DNAC wait for the
+    consumers running its jobs, so the others keep going.
+    A run of a job still running or waiting is skipped.'''
     while True:
         b = jobqueue.get()
-        if b[0]:
-            backup(b[1], b[2], b[3])
+        if not b[0]:
+            continue
+
+        dnac_id = b[1]['id']
+        with jobs_lock:
+            if b[4] in pending_jobs:
+                print("[{}] Backup job {} is still pending, this run is skipped".format(b[1]['addr'], b[4]))
+                continue
+            pending_jobs.add(b[4])
+
+            if running_jobs[dnac_id] >= settings["JOB_DNAC_CONCURRENCY"]:
+                waiting_jobs[dnac_id].append(b)
+                continue
+            running_jobs[dnac_id] += 1
+
+        while b is not None:
+            try:
+                print(backup(b[1], b[2], b[3], settings["BACKUP_INCREMENTAL"]))
+            except Exception as e:
+                print("[{}] Backup job failed: {}".format(b[1]['addr'], e))
+
+            with jobs_lock:
+                pending_jobs.discard(b[4])
+                b = waiting_jobs[dnac_id].popleft() if waiting_jobs[dnac_id] else None
+                if b is None:
+                    running_jobs[dnac_id] -= 1
 
 
 def job_service(actionqueue):
@@ -399,7 +1045,7 @@ def job_service(actionqueue):
 
 
 def restconf_restore(addr, payload, user, pubkey):
-    restconf_sess = requests.Session()
+    restconf_sess = ThrottledSession()
     
     url = "https://{}/restconf/data/Cisco-IOS-XE-native:native".format(addr)
 
@@ -30,12 +30,104 @@ __copyright__ = "Copyright (c) 2021 Cisco and/or its affiliates."
 __license__ = "Cisco Sample Code License, Version 1.1"
 
 
+import hashlib
+import os
 import sqlite3
+import threading
+import zlib
 
 import click
 from flask import current_app, g
 from flask.cli import with_appcontext
 
+# Preset dictionary for zlib, made of lines that appear in most IOS and
+# IOS-XE configurations. zlib favours the end of the dictionary, so the
+# most common fragments come last. Changing it requires a new codec name.
+IOS_ZDICT = (
+    b"Building configuration...\n\nCurrent configuration : bytes\n"
+    b"! Last configuration change at  UTC\n! NVRAM config last updated at \n"
+    b"version 17.3\nservice timestamps debug datetime msec\n"
+    b"service timestamps log datetime msec\nservice password-encryption\n"
+    b"service call-home\nplatform punt-keepalive disable-kernel-core\n"
+    b"boot-start-marker\nboot-end-marker\nvrf definition Mgmt-vrf\n"
+    b" address-family ipv4\n exit-address-family\n address-family ipv6\n"
+    b"logging buffered\nno logging console\nenable secret 9 \n"
+    b"aaa new-model\naaa authentication login default local\n"
+    b"aaa authorization exec default local\naaa session-id common\n"
+    b"clock timezone\nswitch 1 provision\nip routing\nip domain name\n"
+    b"ip name-server\nlogin on-success log\nno ip http server\n"
+    b"ip http authentication local\nip http secure-server\n"
+    b"ip ssh version 2\nip forward-protocol nd\nip route 0.0.0.0 0.0.0.0\n"
+    b"crypto pki trustpoint TP-self-signed-\n enrollment selfsigned\n"
+    b" subject-name cn=IOS-Self-Signed-Certificate-\n revocation-check none\n"
+    b" rsakeypair TP-self-signed-\ncrypto pki certificate chain TP-self-signed-\n"
+    b" certificate self-signed 01\n  \tquit\nlicense boot level\n"
+    b"diagnostic bootup level minimal\nspanning-tree mode rapid-pvst\n"
+    b"spanning-tree extend system-id\nredundancy\n mode sso\n"
+    b"transceiver type all\n monitoring\nvlan \n name \n"
+    b"username  privilege 15 secret 9 \n"
+    b"class-map match-any system-cpp-police-\n description \n"
+    b"policy-map system-cpp-policy\n"
+    b"router bgp \n bgp log-neighbor-changes\n neighbor  remote-as \n"
+    b"router ospf \n network  area 0\n"
+    b"snmp-server community  RO\nsnmp-server location\n"
+    b"ntp server \nline con 0\n stopbits 1\nline vty 0 4\n"
+    b"line vty 5 15\n exec-timeout \n transport input ssh\n"
+    b" login local\nend\n"
+    b"interface Vlan1\n no ip address\n shutdown\n"
+    b"interface Loopback0\n ip address  255.255.255.255\n"
+    b"interface GigabitEthernet0/0\n vrf forwarding Mgmt-vrf\n"
+    b" negotiation auto\n"
+    b"interface TenGigabitEthernet1/1/\n"
+    b"interface GigabitEthernet1/0/\n description \n"
+    b" switchport access vlan \n switchport mode access\n"
+    b" switchport trunk allowed vlan \n switchport mode trunk\n"
+    b" spanning-tree portfast\n ip address  255.255.255.0\n"
+    b" no shutdown\n!\n!\ninterface GigabitEthernet1/0/\n!\n"
+)
+
+
+
+# Settings of the database, taken from the app by init_app so that the
+# background jobs can connect without an application context.
+settings = {}
+
+# Connections opened by each thread to each database, reused until the
+# thread exits.
+connections = threading.local()
+
+
+def connect(config=None):
+    """Return the connection of the current thread to the database of
+    the given configuration, or of the background settings, opening it
+    the first time. Connections use WAL so that readers never wait for
+    the backup writer, and the other pragmas trade a little durability
+    on power loss for throughput.
+    """
+    if config is None:
+        config = settings
+
+    if not hasattr(connections, "dbs"):
+        connections.dbs = {}
+
+    db = connections.dbs.get(config["DATABASE"])
+
+    if db is None:
+        db = sqlite3.connect(
+            config["DATABASE"],
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            timeout=config["DATABASE_BUSY_TIMEOUT"] / 1000,
+        )
+        db.row_factory = sqlite3.Row
+        db.execute("PRAGMA journal_mode = WAL")
+        db.execute("PRAGMA synchronous = NORMAL")
+        db.execute("PRAGMA busy_timeout = {:d}".format(config["DATABASE_BUSY_TIMEOUT"]))
+        db.execute("PRAGMA mmap_size = {:d}".format(config["DATABASE_MMAP_SIZE"]))
+        db.execute("PRAGMA cache_size = {:d}".format(-config["DATABASE_CACHE_SIZE"] // 1024))
+        connections.dbs[config["DATABASE"]] = db
+
+    return db
+
 
 def get_db():
     """Connect to the application's configured database. The connection
@@ -43,22 +135,136 @@ def get_db():
     again.
     """
     if "db" not in g:
-        g.db = sqlite3.connect(
-            current_app.config["DATABASE"], detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.db.row_factory = sqlite3.Row
+        g.db = connect(current_app.config)
 
     return g.db
 
 
 def close_db(e=None):
-    """If this request connected to the database, close the
-    connection.
+    """If this request connected to the database, roll back what it
+    left uncommitted. The connection stays open for the next request
+    of the same thread.
     """
     db = g.pop("db", None)
 
     if db is not None:
-        db.close()
+        db.rollback()
+
+
+def compress(content):
+    """Compress a configuration for the blob store. Return the stored
+    bytes along with the name of the codec that produced them.
+    """
+    compressor = zlib.compressobj(9, zdict=IOS_ZDICT)
+    return compressor.compress(content.encode("utf8")) + compressor.flush(), "zlib"
+
+
+def decompress(content, compression):
+    """Return the configuration text of a blob stored with the given
+    codec. Blobs written before compression was introduced are plain
+    text and are returned unchanged.
+    """
+    if compression is None:
+        return content
+    elif compression == "zlib":
+        decompressor = zlib.decompressobj(zdict=IOS_ZDICT)
+        return (decompressor.decompress(content) + decompressor.flush()).decode("utf8")
+    else:
+        raise ValueError(f"Unknown blob compression {compression}.")
+
+
+def blob_content(row):
+    """Decompress the ``content`` of a row selected with its
+    ``compression`` column. Call it only when the text is needed.
+    """
+    return decompress(row["content"], row["compression"])
+
+
+def put_blob(db, content):
+    """Store a configuration in the content-addressed blob store and
+    return the id of its blob. Identical configurations share a single
+    blob, so storing an unchanged configuration only costs a lookup.
+    """
+    digest = hashlib.sha256(content.encode("utf8")).hexdigest()
+
+    blob = db.execute(BLOB_ID, (digest,)).fetchone()
+    if blob is None:
+        cursor = db.execute(
+            "INSERT OR IGNORE INTO blob (digest, content, compression) VALUES (?, ?, ?)",
+            (digest, *compress(content)),
+        )
+        if cursor.rowcount:
+            db.execute(
+                "INSERT INTO blob_index (rowid, content) VALUES (?, ?)",
+                (cursor.lastrowid, content),
+            )
+        blob = db.execute(BLOB_ID, (digest,)).fetchone()
+
+    return blob[0]
+
+
+def insert_backup(db, device_id, config_type, content):
+    """Record a new backup version pointing to the blob of its content,
+    and make it the latest backup of its device and configuration type.
+    """
+    cursor = db.execute(
+        "INSERT INTO backup (device_id, config_type, blob_id) VALUES (?, ?, ?)",
+        (device_id, config_type, put_blob(db, content)),
+    )
+    db.execute(
+        "INSERT OR REPLACE INTO latest_backup (device_id, config_type, backup_id) VALUES (?, ?, ?)",
+        (device_id, config_type, cursor.lastrowid),
+    )
+
+
+def refresh_latest(db):
+    """Point the latest backups that were deleted to the most recent
+    backup left for their device and configuration type, if any.
+    """
+    db.execute("DELETE FROM latest_backup WHERE backup_id NOT IN (SELECT id FROM backup)")
+    db.execute(
+        "INSERT INTO latest_backup (device_id, config_type, backup_id)"
+        " SELECT device_id, config_type, MAX(id) FROM backup b"
+        " WHERE NOT EXISTS (SELECT 1 FROM latest_backup l WHERE l.device_id = b.device_id AND l.config_type = b.config_type)"
+        " GROUP BY device_id, config_type"
+    )
+
+
+def purge_blobs(db):
+    """Delete the blobs that are no longer referenced by any backup,
+    along with their entries in the search index.
+    """
+    orphans = db.execute(
+        "SELECT id, content, compression FROM blob WHERE id NOT IN (SELECT blob_id FROM backup)"
+    )
+    # A contentless index needs the original text to delete an entry.
+    db.executemany(
+        "INSERT INTO blob_index (blob_index, rowid, content) VALUES ('delete', ?, ?)",
+        [(b["id"], blob_content(b)) for b in orphans],
+    )
+    db.execute("DELETE FROM blob WHERE id NOT IN (SELECT blob_id FROM backup)")
+
+
+def match_expression(query):
+    """Return the full-text expression matching the blobs that contain
+    ``query``, or None if it is too short for the trigram index.
+    """
+    if len(query) < 3:
+        return None
+
+    return '"{}"'.format(query.replace('"', '""'))
+
+
+def migrations():
+    """Return the (version, file name) of the schema migrations, in the
+    order they apply. The version of a migration is the number its file
+    name starts with.
+    """
+    return sorted(
+        (int(name.split("_", 1)[0]), name)
+        for name in os.listdir(os.path.join(current_app.root_path, "migrations"))
+        if name.endswith(".sql")
+    )
 
 
 def init_db():
@@ -68,6 +274,180 @@ def init_db():
     with current_app.open_resource("schema.sql") as f:
         db.executescript(f.read().decode("utf8"))
 
+    # the schema is already up to date with every migration
+    db.execute("PRAGMA user_version = {:d}".format(max([0] + [v for v, name in migrations()])))
+
+
+def migrate_db():
+    """Apply the migrations newer than the version of the database, each
+    in its own transaction. Return the versions applied.
+    """
+    db = get_db()
+    db.create_function(
+        "sha256", 1, lambda s: hashlib.sha256(s.encode("utf8")).hexdigest(), deterministic=True
+    )
+    version = db.execute("PRAGMA user_version").fetchone()[0]
+    applied = []
+
+    for v, name in migrations():
+        if v <= version:
+            continue
+
+        with current_app.open_resource(os.path.join("migrations", name)) as f:
+            db.executescript(
+                "BEGIN;\n{}\nPRAGMA user_version = {:d};\nCOMMIT;".format(f.read().decode("utf8"), v)
+            )
+        applied.append(v)
+
+    return applied
+
+
+# Queries run on every page load, search or backup. The views and the
+# background services run them from here, so that check_queries covers
+# what actually runs. None of them may scan a whole table.
+USER_DNAC = "SELECT * FROM user_dnac WHERE user_id = ? AND dnac_id = ?"
+USER_DNACS = (
+    "SELECT id, addr, dnac_user, dnac_pass, restconf_user, restconf_pass"
+    " FROM dnac d JOIN user_dnac ud ON d.id = ud.dnac_id"
+    " WHERE user_id = ?"
+    " ORDER BY addr"
+)
+USER_DNAC_DETAILS = (
+    "SELECT id, addr, dnac_user, dnac_pass, restconf_user, restconf_pass"
+    " FROM dnac d JOIN user_dnac ud ON d.id = ud.dnac_id"
+    " WHERE id = ? AND user_id = ?"
+)
+DNAC = "SELECT * FROM dnac WHERE id = ?"
+STALE_DNAC = "SELECT *, synced IS NULL OR synced < datetime('now', ?) AS stale FROM dnac WHERE id = ?"
+DEVICE = "SELECT * FROM device WHERE id = ?"
+DEVICE_COUNT = "SELECT count(*) FROM device WHERE dnac_id = ?"
+DEVICE_PAGE = "SELECT * FROM device WHERE dnac_id = ? ORDER BY hostname LIMIT ? OFFSET ?"
+DEVICE_PAGE_VERSIONS = (
+    "SELECT b.id, b.device_id, b.created, b.config_type"
+    " FROM (SELECT id FROM device WHERE dnac_id = ? ORDER BY hostname LIMIT ? OFFSET ?) d"
+    " JOIN backup b ON b.id IN ("
+    "   SELECT id FROM backup WHERE device_id = d.id"
+    "   ORDER BY created DESC, id DESC LIMIT ?)"
+    " ORDER BY b.device_id, b.created DESC, b.id DESC"
+)
+DEVICE_VERSIONS = (
+    "SELECT id, created, config_type FROM backup"
+    " WHERE device_id = ?"
+    " ORDER BY created DESC, id DESC LIMIT ?"
+)
+DEVICE_VERSIONS_BEFORE = (
+    "SELECT id, created, config_type FROM backup"
+    " WHERE device_id = ?"
+    " AND (created, id) < (SELECT created, id FROM backup WHERE id = ?)"
+    " ORDER BY created DESC, id DESC LIMIT ?"
+)
+BACKUP = (
+    "SELECT b.*, digest, content, compression, dnac_id, hostname"
+    " FROM backup b JOIN blob bl ON b.blob_id = bl.id"
+    " JOIN device d ON b.device_id = d.id"
+    " WHERE b.id = ?"
+)
+RESTCONF_BACKUP = (
+    "SELECT b.*, content, compression"
+    " FROM backup b JOIN blob bl ON b.blob_id = bl.id"
+    " WHERE b.id = ? AND config_type = 'RESTCONF'"
+)
+BLOB_CONTENT = "SELECT content, compression FROM blob WHERE id = ?"
+BLOB_CONTENTS = "SELECT id, content, compression FROM blob WHERE id IN (SELECT value FROM json_each(?))"
+BLOB_ID = "SELECT id FROM blob WHERE digest = ?"
+DNAC_JOBS = (
+    "SELECT j.id, author_id, dnac_id, title, addr, created, frequency, activated, next_run"
+    " FROM job j JOIN dnac d ON j.dnac_id = d.id"
+    " WHERE dnac_id = ?"
+    " ORDER BY title"
+)
+JOB = "SELECT * FROM job WHERE id = ?"
+JOB_SCHEDULE = "SELECT id, frequency, next_run, activated FROM job WHERE id = ?"
+JOB_TARGET = (
+    "SELECT d.id, addr, dnac_user, dnac_pass, restconf_user, restconf_pass, frequency"
+    " FROM job j JOIN user_dnac ud ON j.author_id = ud.user_id AND j.dnac_id = ud.dnac_id"
+    " JOIN dnac d ON j.dnac_id = d.id"
+    " WHERE j.id = ?"
+)
+JOB_NEXT_RUN = "UPDATE job SET next_run = ? WHERE id = ?"
+BACKUP_DEVICES = (
+    "SELECT id AS device_id, uuid AS id, hostname, addr AS managementIpAddress, last_update"
+    " FROM device"
+    " WHERE dnac_id = ? AND connected = 1"
+)
+CHANGED_DEVICES = (
+    BACKUP_DEVICES
+    + " AND (last_update IS NULL OR backup_update IS NOT last_update"
+    " OR backup_time < datetime('now', ?))"
+)
+BACKUP_UPDATE = "UPDATE device SET backup_update = ?, backup_time = CURRENT_TIMESTAMP WHERE id = ?"
+GONE_DEVICES = "UPDATE device SET connected = 0 WHERE dnac_id = ? AND synced IS NOT ?"
+
+
+def search_query(selection, config_type, indexed):
+    """Return the query of the backups of a DNAC to search, all of them
+    or the latest ones, of the given configuration type. An indexed
+    search also takes the FTS expression narrowing the scan.
+    """
+    filter = "b.config_type <> 'RESTCONF'"
+
+    if config_type == "running":
+        filter = "b.config_type = 'CLI Running'"
+    elif config_type == "startup":
+        filter = "b.config_type = 'CLI Startup'"
+
+    if indexed:
+        filter += " AND b.blob_id IN (SELECT rowid FROM blob_index WHERE blob_index MATCH ?)"
+
+    if selection == "all":
+        return (
+            "SELECT b.id, device_id, created, config_type, blob_id, dnac_id, uuid, hostname"
+            " FROM backup b JOIN device d ON b.device_id = d.id"
+            " WHERE dnac_id = ? AND {}"
+            " ORDER BY hostname, created".format(filter)
+        )
+
+    return (
+        "SELECT b.id, b.device_id, created, b.config_type, blob_id, dnac_id, uuid, hostname"
+        " FROM device d JOIN latest_backup l ON l.device_id = d.id"
+        " JOIN backup b ON l.backup_id = b.id"
+        " WHERE dnac_id = ? AND {}"
+        " ORDER BY hostname, b.config_type".format(filter)
+    )
+
+
+HOT_QUERIES = [
+    USER_DNAC, USER_DNACS, USER_DNAC_DETAILS, DNAC, STALE_DNAC,
+    DEVICE, DEVICE_COUNT, DEVICE_PAGE, DEVICE_PAGE_VERSIONS, DEVICE_VERSIONS, DEVICE_VERSIONS_BEFORE,
+    BACKUP, RESTCONF_BACKUP, BLOB_CONTENT, BLOB_CONTENTS, BLOB_ID,
+    DNAC_JOBS, JOB, JOB_SCHEDULE, JOB_TARGET, JOB_NEXT_RUN,
+    BACKUP_DEVICES, CHANGED_DEVICES, BACKUP_UPDATE, GONE_DEVICES,
+] + [
+    search_query(selection, config_type, indexed)
+    for selection in ("all", "latest")
+    for config_type in ("all", "running", "startup")
+    for indexed in (True, False)
+]
+
+# Jobs read once when the scheduler starts, which may scan them all.
+ACTIVE_JOBS = "SELECT id, frequency, next_run FROM job WHERE activated = 1"
+
+
+def check_queries():
+    """Return the plan of each hot query that scans a whole table."""
+    db = get_db()
+    scans = []
+
+    for query in HOT_QUERIES:
+        plan = db.execute("EXPLAIN QUERY PLAN " + query, (None,) * query.count("?")).fetchall()
+        details = [p["detail"] for p in plan]
+        # subqueries materialized from an index are small enough to scan
+        materialized = {"SCAN " + d[len("MATERIALIZE "):] for d in details if d.startswith("MATERIALIZE ")}
+        if any(d.startswith("SCAN ") and "VIRTUAL TABLE" not in d and d not in materialized for d in details):
+            scans.append((query, details))
+
+    return scans
+
 
 @click.command("init-db")
 @with_appcontext
@@ -77,9 +457,72 @@ def init_db_command():
     click.echo("Initialized the database.")
 
 
+@click.command("migrate-db")
+@with_appcontext
+def migrate_db_command():
+    """Upgrade the tables of an existing database."""
+    applied = migrate_db()
+    if applied:
+        click.echo("Applied migrations {}.".format(", ".join(map(str, applied))))
+    else:
+        click.echo("The database is up to date.")
+
+
+@click.command("check-queries")
+@with_appcontext
+def check_queries_command():
+    """Fail if a hot query scans a whole table."""
+    scans = check_queries()
+    for query, details in scans:
+        click.echo(query)
+        for d in details:
+            click.echo(f"  {d}")
+    if scans:
+        raise click.ClickException(f"{len(scans)} queries scan a whole table.")
+    click.echo(f"All {len(HOT_QUERIES)} queries use an index.")
+
+
+def compress_db(batch_size=100):
+    """Compress the blobs stored as plain text. Return the number of
+    blobs compressed.
+    """
+    db = get_db()
+    count = 0
+
+    while True:
+        blobs = db.execute(
+            "SELECT id, content FROM blob WHERE compression IS NULL LIMIT ?",
+            (batch_size,),
+        ).fetchall()
+        if not blobs:
+            return count
+
+        db.executemany(
+            "UPDATE blob SET content = ?, compression = ? WHERE id = ?",
+            ((*compress(b["content"]), b["id"]) for b in blobs),
+        )
+        db.commit()
+        count += len(blobs)
+
+
+@click.command("compress-db")
+@click.option("--vacuum", is_flag=True, help="Reclaim the freed space afterwards.")
+@with_appcontext
+def compress_db_command(vacuum):
+    """Compress the backed-up configurations stored as plain text."""
+    count = compress_db()
+    if vacuum:
+        get_db().execute("VACUUM")
+    click.echo(f"Compressed {count} configurations.")
+
+
 def init_app(app):
     """Register database functions with the Flask app. This is called by
     the application factory.
     """
+    settings.update(app.config)
     app.teardown_appcontext(close_db)
     app.cli.add_command(init_db_command)
+    app.cli.add_command(migrate_db_command)
+    app.cli.add_command(check_queries_command)
+    app.cli.add_command(compress_db_command)
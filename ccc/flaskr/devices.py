@@ -30,16 +30,23 @@ __copyright__ = "Copyright (c) 2021 Cisco and/or its affiliates."
 __license__ = "Cisco Sample Code License, Version 1.1"
 
 
-import difflib
+import re
 
-from flask import (Blueprint, flash, g, redirect, render_template, request,
-                   url_for)
+from flask import (Blueprint, current_app, flash, g, jsonify, redirect,
+                   render_template, request, stream_template, url_for)
 from flask.helpers import make_response
 from werkzeug.exceptions import abort
 
 from flaskr.auth import login_required
-from flaskr.ccc import restconf_restore, search, update_devices
-from flaskr.db import get_db
+from flaskr.ccc import (refresh_devices, restconf_restore, search,
+                        update_devices)
+from flaskr.db import (BACKUP, DEVICE, DEVICE_COUNT, DEVICE_PAGE,
+                       DEVICE_PAGE_VERSIONS, DEVICE_VERSIONS,
+                       DEVICE_VERSIONS_BEFORE, DNAC, RESTCONF_BACKUP,
+                       STALE_DNAC, USER_DNAC, blob_content, get_db,
+                       purge_blobs, refresh_latest)
+from flaskr.diff import cached_diff, cached_sections, diff_rows, diff_sections
+from flaskr.patterns import compile_query
 
 bp = Blueprint("devices", __name__)
 
@@ -70,36 +77,12 @@ def index(id):
         elif "view" in request.form:
             return redirect(url_for("devices.view_backup", id=a_ver))
         elif "compare" in request.form:
-            old = (
-                get_db()
-                .execute(
-                    "SELECT *"
-                    " FROM backup"
-                    " WHERE id = ?",
-                    (a_ver,),
-                )
-                .fetchone()
-            )
-            new = (
-                get_db()
-                .execute(
-                    "SELECT *"
-                    " FROM backup"
-                    " WHERE id = ?",
-                    (b_ver,),
-                )
-                .fetchone()
-            )
-            hd = difflib.HtmlDiff()
-            
-            return hd.make_file(old['content'].splitlines(), new['content'].splitlines())
+            return redirect(url_for("devices.compare", a=a_ver, b=b_ver))
         elif "restore" in request.form:
             device = (
                 get_db()
                 .execute(
-                    "SELECT *"
-                    " FROM device"
-                    " WHERE id = ?",
+                    DEVICE,
                     (a,),
                 )
                 .fetchone()
@@ -107,9 +90,7 @@ def index(id):
             backup = (
                 get_db()
                 .execute(
-                    "SELECT *"
-                    " FROM backup"
-                    " WHERE id = ? AND config_type = 'RESTCONF'",
+                    RESTCONF_BACKUP,
                     (a_ver,),
                 )
                 .fetchone()
@@ -119,23 +100,19 @@ def index(id):
             user_dnac = (
                 get_db()
                 .execute(
-                    "SELECT *"
-                    " FROM user_dnac"
-                    " WHERE user_id = ? AND dnac_id = ?",
+                    USER_DNAC,
                     (g.user["id"], id),
                 )
                 .fetchone()
             )
             
-            return "Response status code: {}".format(restconf_restore(device['addr'], backup['content'], user_dnac, None))
+            return "Response status code: {}".format(restconf_restore(device['addr'], blob_content(backup), user_dnac, None))
 
     db = get_db()
     user_dnac = (
         db
         .execute(
-            "SELECT *"
-            " FROM user_dnac"
-            " WHERE user_id = ? AND dnac_id = ?",
+            USER_DNAC,
             (g.user["id"], id),
         )
         .fetchone()
@@ -146,59 +123,132 @@ def index(id):
     dnac = (
         db
         .execute(
-            "SELECT *"
-            " FROM dnac"
-            " WHERE id = ?",
-            (id,),
+            STALE_DNAC,
+            ("-{} seconds".format(current_app.config["INVENTORY_TTL"]), id),
         )
         .fetchone()
     )
 
-    update_devices(dnac, user_dnac)
+    # The page is rendered from the saved inventory, which is updated in
+    # the background once it is stale. Only the first update is awaited.
+    if dnac["synced"] is None:
+        update_devices(dnac, user_dnac)
+    elif dnac["stale"]:
+        refresh_devices(dnac, user_dnac)
+
+    page_size = current_app.config["DEVICES_PAGE_SIZE"]
+    versions_size = current_app.config["VERSIONS_PAGE_SIZE"]
+    page = max(request.args.get("page", 1, type=int), 1)
+    count = db.execute(
+        DEVICE_COUNT,
+        (id,),
+    ).fetchone()[0]
+    pages = max((count + page_size - 1) // page_size, 1)
 
     devices = db.execute(
-        "SELECT *"
-        " FROM device"
-        " WHERE dnac_id = ?"
-        " ORDER BY hostname",
-        (id,),
-    ).fetchall()
-    backups = db.execute(
-        "SELECT b.id, dnac_id, device_id, created, config_type, content"
-        " FROM backup b JOIN device d ON b.device_id = d.id"
-        " WHERE dnac_id = ?"
-        " ORDER BY created DESC",
-        (id,),
+        DEVICE_PAGE,
+        (id, page_size, (page - 1) * page_size),
     ).fetchall()
+
+    # Only the latest versions of the listed devices are read, one more
+    # than shown to tell whether older ones can be loaded.
+    versions = {}
+    for backup in db.execute(
+        DEVICE_PAGE_VERSIONS,
+        (id, page_size, (page - 1) * page_size, versions_size + 1),
+    ):
+        versions.setdefault(backup["device_id"], []).append(backup)
+    more = {d: len(v) > versions_size for d, v in versions.items()}
+    versions = {d: v[:versions_size] for d, v in versions.items()}
+
+    return render_template(
+        "devices/index.html", id=id, dnac=dnac, devices=devices,
+        versions=versions, more=more, page=page, pages=pages,
+    )
+
+
+@bp.route("/devices/<int:id>/versions")
+@login_required
+def versions(id):
+    get_device(id)
+    before = request.args.get("before", type=int)
+    limit = current_app.config["VERSIONS_PAGE_SIZE"]
+    db = get_db()
+
+    # The versions older than the last one already listed, newest first.
+    if before is None:
+        backups = db.execute(
+            DEVICE_VERSIONS,
+            (id, limit + 1),
+        ).fetchall()
+    else:
+        backups = db.execute(
+            DEVICE_VERSIONS_BEFORE,
+            (id, before, limit + 1),
+        ).fetchall()
+
+    return jsonify(
+        versions=[
+            {"id": b["id"], "created": str(b["created"]), "config_type": b["config_type"]}
+            for b in backups[:limit]
+        ],
+        more=len(backups) > limit,
+    )
+
+
+@bp.route("/dnacs/<int:id>/devices/refresh")
+@login_required
+def refresh(id):
+    db = get_db()
+    user_dnac = (
+        db
+        .execute(
+            USER_DNAC,
+            (g.user["id"], id),
+        )
+        .fetchone()
+    )
+    if user_dnac is None:
+        abort(403)
     
-    return render_template("devices/index.html", id=id, devices=devices, backups=backups)
+    dnac = (
+        db
+        .execute(
+            DNAC,
+            (id,),
+        )
+        .fetchone()
+    )
+
+    if refresh_devices(dnac, user_dnac):
+        flash("The list of devices is being updated, reload the page in a moment.")
+    else:
+        flash("The list of devices is already being updated.")
+    return redirect(url_for("devices.index", id=id))
 
 
 def get_device(id, check_owner=True):
     device = (
         get_db()
         .execute(
-            "SELECT *"
-            " FROM device"
-            " WHERE id = ?",
+            DEVICE,
             (id,),
         )
         .fetchone()
     )
+
+    if device is None:
+        abort(404, f"Device id {id} doesn't exist.")
+
     user_dnac = (
         get_db()
         .execute(
-            "SELECT *"
-            " FROM user_dnac"
-            " WHERE user_id = ? AND dnac_id = ?",
+            USER_DNAC,
             (g.user["id"], device["dnac_id"]),
         )
         .fetchone()
     )
 
-    if device is None:
-        abort(404, f"Device id {id} doesn't exist.")
-
     if check_owner and user_dnac is None:
         abort(403)
 
@@ -210,6 +260,7 @@ def get_device(id, check_owner=True):
 def search_in_backups(id):
     if request.method == "POST":
         query = request.form["query"]
+        mode = request.form.get("mode", "literal")
         selection = request.form["selection"]
         config_type = request.form["type"]
         error = None
@@ -220,60 +271,117 @@ def search_in_backups(id):
             error = "Selection choice is required."
         elif not config_type:
             error = "Configuration type selection is required."
+        else:
+            try:
+                pattern = compile_query(mode, query, request.form.get("include", ""), request.form.get("exclude", ""))
+            except re.error as e:
+                error = f"Invalid regular expression: {e}."
         
         if error is not None:
             flash(error)
         else:
-            return render_template("devices/search.html", id=id, results=search(selection, config_type, query, id))
+            # results are rendered while the search is still running
+            return stream_template("devices/search.html", id=id, results=search(selection, config_type, pattern, id))
     
     return render_template("devices/search.html", id=id)
 
 
-@bp.route("/backups/<int:id>")
-@login_required
-def view_backup(id):
-    db = get_db()
+def get_backup(id, check_owner=True):
     backup = (
-        db
+        get_db()
         .execute(
-            "SELECT *"
-            " FROM backup"
-            " WHERE id = ?",
+            BACKUP,
             (id,),
         )
         .fetchone()
     )
+
     if backup is None:
-        abort(404)
-    
-    device = (
-        db
-        .execute(
-            "SELECT *"
-            " FROM device"
-            " WHERE id = ?",
-            (backup['device_id'],),
-        )
-        .fetchone()
-    )
+        abort(404, f"Backup id {id} doesn't exist.")
 
     user_dnac = (
-        db
+        get_db()
         .execute(
-            "SELECT *"
-            " FROM user_dnac"
-            " WHERE user_id = ? AND dnac_id = ?",
-            (g.user["id"], device['dnac_id']),
+            USER_DNAC,
+            (g.user["id"], backup["dnac_id"]),
         )
         .fetchone()
     )
-    if user_dnac is None:
+
+    if check_owner and user_dnac is None:
         abort(403)
+
+    return backup
+
+
+@bp.route("/backups/<int:id>")
+@login_required
+def view_backup(id):
+    backup = get_backup(id)
     
-    response = make_response(backup['content'], 200)
+    response = make_response(blob_content(backup), 200)
     response.mimetype = "text/plain"
     return response
 
+
+@bp.route("/backups/<int:id>/lines")
+@login_required
+def backup_lines(id):
+    backup = get_backup(id)
+    start = request.args.get("start", 0, type=int)
+    stop = request.args.get("stop", type=int)
+
+    return jsonify(lines=blob_content(backup).splitlines()[start:stop])
+
+
+@bp.route("/backups/<int:a>/compare/<int:b>")
+@login_required
+def compare(a, b):
+    old = get_backup(a)
+    new = get_backup(b)
+    old_lines = blob_content(old).splitlines()
+    new_lines = blob_content(new).splitlines()
+
+    # Versions never change, the diff of a pair is computed once and
+    # only the unchanged lines near a change are shown unless asked.
+    opcodes = cached_diff((a, b), old_lines, new_lines, current_app.config["DIFF_CACHE_SIZE"])
+    context = None if "full" in request.args else current_app.config["DIFF_CONTEXT"]
+
+    return stream_template(
+        "devices/compare.html", old=old, new=new, full=context is None,
+        rows=diff_rows(old_lines, new_lines, opcodes, context),
+    )
+
+
+def section_changes(a, b):
+    old = get_backup(a)
+    new = get_backup(b)
+    size = current_app.config["SECTION_CACHE_SIZE"]
+
+    # Trees are shared by every version with the same content.
+    changes = diff_sections(
+        cached_sections(old["digest"], blob_content(old), size),
+        cached_sections(new["digest"], blob_content(new), size),
+    )
+    return old, new, changes
+
+
+@bp.route("/backups/<int:a>/sections/<int:b>")
+@login_required
+def compare_sections(a, b):
+    old, new, changes = section_changes(a, b)
+
+    return render_template("devices/sections.html", old=old, new=new, changes=changes)
+
+
+@bp.route("/backups/<int:a>/sections/<int:b>.json")
+@login_required
+def compare_sections_json(a, b):
+    old, new, changes = section_changes(a, b)
+
+    return jsonify(old=old["id"], new=new["id"], changes=changes)
+
+
 @bp.route("/dnacs/<int:id>/devices/purge", methods=("GET", "POST"))
 @login_required
 def purge(id):
@@ -288,15 +396,15 @@ def purge(id):
         if "backups" in request.form and old is not None:
             db.execute("DELETE FROM backup WHERE id IN (SELECT b.id FROM backup b JOIN device d ON b.device_id = d.id WHERE dnac_id = ? AND created < ?)", (id,old))
         
+        refresh_latest(db)
+        purge_blobs(db)
         db.commit()
         return redirect(url_for("devices.index", id=id))
 
     dnac = (
         db
         .execute(
-            "SELECT *"
-            " FROM dnac"
-            " WHERE id = ?",
+            DNAC,
             (id,),
         )
         .fetchone()
@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Configuration Compliance Check
+
+Copyright (c) 2021 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+
+"""
+
+
+from __future__ import absolute_import, division, print_function
+
+__author__ = "Héctor Cavalcanti Saavedra <hcavalca@cisco.com>"
+__contributors__ = [
+    "Sarah Louise Justin <sajustin@cisco.com>"
+]
+__copyright__ = "Copyright (c) 2021 Cisco and/or its affiliates."
+__license__ = "Cisco Sample Code License, Version 1.1"
+
+
+import collections
+import hashlib
+import threading
+
+
+# Past this many edits, the rest of a region that has no line in
+# common with the other version is shown as replaced.
+MAX_COST = 1024
+
+
+class Cache:
+    '''The latest few values computed, shared by the
+    threads of the app.'''
+
+    def __init__(self):
+        self.values = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, compute, size):
+        with self.lock:
+            if key in self.values:
+                self.values.move_to_end(key)
+                return self.values[key]
+
+        value = compute()
+
+        with self.lock:
+            self.values[key] = value
+            while len(self.values) > size:
+                self.values.popitem(last=False)
+        return value
+
+
+diffs = Cache()
+trees = Cache()
+
+
+def intern_lines(a, b):
+    '''Maps the lines of both versions to integers,
+    equal lines to the same integer.'''
+    codes = {}
+    return ([codes.setdefault(line, len(codes)) for line in a],
+            [codes.setdefault(line, len(codes)) for line in b])
+
+
+def unique_anchors(a, alo, ahi, b, blo, bhi):
+    '''Returns the lines found exactly once in each
+    version, in the longest order they share.'''
+    count = collections.Counter(a[alo:ahi])
+    unique_a = {x: i for i, x in enumerate(a[alo:ahi], alo) if count[x] == 1}
+    count = collections.Counter(b[blo:bhi])
+    pairs = [(unique_a[x], j) for j, x in enumerate(b[blo:bhi], blo)
+             if count[x] == 1 and x in unique_a]
+    pairs.sort()
+
+    # Patience sorting: the longest increasing sequence of positions in b.
+    tails = []
+    previous = []
+    for n, (i, j) in enumerate(pairs):
+        lo, hi = 0, len(tails)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if pairs[tails[mid]][1] < j:
+                lo = mid + 1
+            else:
+                hi = mid
+        previous.append(tails[lo - 1] if lo else None)
+        if lo == len(tails):
+            tails.append(n)
+        else:
+            tails[lo] = n
+
+    anchors = []
+    n = tails[-1] if tails else None
+    while n is not None:
+        anchors.append(pairs[n])
+        n = previous[n]
+    return anchors[::-1]
+
+
+def middle_snake(a, alo, ahi, b, blo, bhi):
+    '''Finds a point of a shortest edit path between the two
+    regions by running Myers' algorithm from both ends at
+    once, in linear space. Returns None if the path is
+    longer than MAX_COST.'''
+    n = ahi - alo
+    m = bhi - blo
+    max_d = min((n + m + 1) // 2, MAX_COST)
+    offset = max_d + 1
+    length = 2 * offset + 1
+    v1 = [-1] * length
+    v2 = [-1] * length
+    v1[offset + 1] = 0
+    v2[offset + 1] = 0
+    delta = n - m
+    front = delta % 2 != 0
+    k1start = k1end = k2start = k2end = 0
+
+    for d in range(max_d):
+        for k1 in range(-d + k1start, d + 1 - k1end, 2):
+            k1_offset = offset + k1
+            if k1 == -d or (k1 != d and v1[k1_offset - 1] < v1[k1_offset + 1]):
+                x1 = v1[k1_offset + 1]
+            else:
+                x1 = v1[k1_offset - 1] + 1
+            y1 = x1 - k1
+            while x1 < n and y1 < m and a[alo + x1] == b[blo + y1]:
+                x1 += 1
+                y1 += 1
+            v1[k1_offset] = x1
+            if x1 > n:
+                k1end += 2
+            elif y1 > m:
+                k1start += 2
+            elif front:
+                k2_offset = offset + delta - k1
+                if 0 <= k2_offset < length and v2[k2_offset] != -1:
+                    if x1 >= n - v2[k2_offset]:
+                        return x1, y1
+
+        for k2 in range(-d + k2start, d + 1 - k2end, 2):
+            k2_offset = offset + k2
+            if k2 == -d or (k2 != d and v2[k2_offset - 1] < v2[k2_offset + 1]):
+                x2 = v2[k2_offset + 1]
+            else:
+                x2 = v2[k2_offset - 1] + 1
+            y2 = x2 - k2
+            while x2 < n and y2 < m and a[ahi - x2 - 1] == b[bhi - y2 - 1]:
+                x2 += 1
+                y2 += 1
+            v2[k2_offset] = x2
+            if x2 > n:
+                k2end += 2
+            elif y2 > m:
+                k2start += 2
+            elif not front:
+                k1_offset = offset + delta - k2
+                if 0 <= k1_offset < length and v1[k1_offset] != -1:
+                    x1 = v1[k1_offset]
+                    if x1 >= n - x2:
+                        return x1, x1 - (k1_offset - offset)
+
+    return None
+
+
+def matching_lines(a, b):
+    '''Yields the pairs of positions of the lines both
+    versions have in common.'''
+    regions = [(0, len(a), 0, len(b), True)]
+
+    while regions:
+        alo, ahi, blo, bhi, patience = regions.pop()
+
+        while alo < ahi and blo < bhi and a[alo] == b[blo]:
+            yield alo, blo
+            alo += 1
+            blo += 1
+        while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+            ahi -= 1
+            bhi -= 1
+            yield ahi, bhi
+        if alo == ahi or blo == bhi:
+            continue
+
+        # Lines unique to each version split the region in smaller
+        # ones first, Myers' algorithm is run on what is left.
+        anchors = unique_anchors(a, alo, ahi, b, blo, bhi) if patience else []
+        if anchors:
+            for i, j in anchors:
+                yield i, j
+                regions.append((alo, i, blo, j, True))
+                alo, blo = i + 1, j + 1
+            regions.append((alo, ahi, blo, bhi, True))
+            continue
+
+        if set(a[alo:ahi]).isdisjoint(b[blo:bhi]):
+            continue
+        snake = middle_snake(a, alo, ahi, b, blo, bhi)
+        if snake is not None:
+            x, y = snake
+            regions.append((alo, alo + x, blo, blo + y, False))
+            regions.append((alo + x, ahi, blo + y, bhi, False))
+
+
+def diff_lines(a, b):
+    '''Returns the opcodes turning the lines a into the
+    lines b, as difflib.SequenceMatcher.get_opcodes.'''
+    codes_a, codes_b = intern_lines(a, b)
+    opcodes = []
+    i = j = 0
+
+    for x, y in sorted(matching_lines(codes_a, codes_b)) + [(len(a), len(b))]:
+        if i < x and j < y:
+            opcodes.append(("replace", i, x, j, y))
+        elif i < x:
+            opcodes.append(("delete", i, x, j, j))
+        elif j < y:
+            opcodes.append(("insert", i, i, j, y))
+        if x < len(a):
+            if opcodes and opcodes[-1][0] == "equal":
+                opcodes[-1] = ("equal", opcodes[-1][1], x + 1, opcodes[-1][3], y + 1)
+            else:
+                opcodes.append(("equal", x, x + 1, y, y + 1))
+        i, j = x + 1, y + 1
+
+    return opcodes
+
+
+def cached_diff(key, a, b, size):
+    '''Returns the opcodes of diff_lines, keeping the
+    latest few in memory under the key.'''
+    return diffs.get(key, lambda: diff_lines(a, b), size)
+
+
+def diff_rows(a, b, opcodes, context=None):
+    '''Yields the rows of a side by side view of the
+    opcodes. With a context, unchanged lines further
+    than that from a change are folded in a single row.'''
+    change = 0
+
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == "equal":
+            folded = context is not None and i2 - i1 > 2 * context + 1
+            if not folded:
+                for i, j in zip(range(i1, i2), range(j1, j2)):
+                    yield {"tag": "equal", "old": i, "new": j, "left": a[i], "right": b[j]}
+                continue
+
+            head = context if i1 > 0 else 0
+            tail = context if i2 < len(a) else 0
+            for i, j in zip(range(i1, i1 + head), range(j1, j1 + head)):
+                yield {"tag": "equal", "old": i, "new": j, "left": a[i], "right": b[j]}
+            yield {"tag": "folded", "old": i1 + head, "new": j1 + head, "count": i2 - i1 - head - tail}
+            for i, j in zip(range(i2 - tail, i2), range(j2 - tail, j2)):
+                yield {"tag": "equal", "old": i, "new": j, "left": a[i], "right": b[j]}
+            continue
+
+        change += 1
+        for n in range(max(i2 - i1, j2 - j1)):
+            i = i1 + n if i1 + n < i2 else None
+            j = j1 + n if j1 + n < j2 else None
+            yield {
+                "tag": tag,
+                "change": change if n == 0 else None,
+                "old": i,
+                "new": j,
+                "left": a[i] if i is not None else "",
+                "right": b[j] if j is not None else "",
+            }
+
+
+class Stanza:
+    '''A line of a configuration and the lines indented
+    under it. The digest covers the whole stanza, so two
+    stanzas with the same digest need not be visited.'''
+
+    __slots__ = ("line", "children", "digest")
+
+    def __init__(self, line):
+        self.line = line
+        self.children = []
+        self.digest = None
+
+    def lines(self):
+        for _, stanza in walk(self):
+            yield stanza.line
+
+    def keyed(self):
+        '''Returns the children by their line, repeated
+        lines told apart by their rank.'''
+        seen = collections.Counter()
+        children = {}
+        for child in self.children:
+            children[child.line, seen[child.line]] = child
+            seen[child.line] += 1
+        return children
+
+
+def walk(stanza):
+    '''Yields the depth and each stanza of the tree,
+    parents before their children.'''
+    stack = [(0, stanza)]
+    while stack:
+        depth, stanza = stack.pop()
+        yield depth, stanza
+        stack.extend((depth + 1, child) for child in reversed(stanza.children))
+
+
+def parse_sections(content):
+    '''Returns the tree of stanzas of a configuration, the
+    root standing for the whole file. "!" separators and
+    blank lines are left out.'''
+    root = Stanza("")
+    stack = [(-1, root)]
+
+    for line in content.splitlines():
+        text = line.lstrip()
+        if not text or text == "!":
+            continue
+        indent = len(line) - len(text)
+        while stack[-1][0] >= indent:
+            stack.pop()
+        stanza = Stanza(line)
+        stack[-1][1].children.append(stanza)
+        stack.append((indent, stanza))
+
+    # children are hashed before their parent
+    for _, stanza in reversed(list(walk(root))):
+        h = hashlib.blake2b(stanza.line.encode(), digest_size=16)
+        for child in stanza.children:
+            h.update(child.digest)
+        stanza.digest = h.digest()
+
+    return root
+
+
+def cached_sections(digest, content, size):
+    '''Returns the tree of parse_sections, keeping the
+    latest few in memory under the digest of the content.'''
+    return trees.get(digest, lambda: parse_sections(content), size)
+
+
+def diff_sections(old, new):
+    '''Returns the stanzas added, removed and modified
+    between two trees. Modified stanzas list the changes
+    of their children, or are reordered if none were
+    added or removed.'''
+    changes = []
+    old_children = old.keyed()
+    new_children = new.keyed()
+
+    for key, stanza in old_children.items():
+        if key not in new_children:
+            changes.append({"section": stanza.line, "status": "removed", "lines": list(stanza.lines())})
+        elif stanza.digest != new_children[key].digest:
+            children = diff_sections(stanza, new_children[key])
+            changes.append({
+                "section": stanza.line,
+                "status": "modified" if children else "reordered",
+                "changes": children,
+            })
+    for key, stanza in new_children.items():
+        if key not in old_children:
+            changes.append({"section": stanza.line, "status": "added", "lines": list(stanza.lines())})
+
+    return changes
@@ -36,7 +36,7 @@ from werkzeug.exceptions import abort
 
 from flaskr.auth import login_required
 from flaskr.ccc import backup
-from flaskr.db import get_db
+from flaskr.db import USER_DNAC_DETAILS, USER_DNACS, get_db
 
 bp = Blueprint("dnacs", __name__)
 
@@ -46,10 +46,7 @@ bp = Blueprint("dnacs", __name__)
 def index():
     db = get_db()
     dnacs = db.execute(
-        "SELECT id, addr, dnac_user, dnac_pass, restconf_user, restconf_pass"
-        " FROM dnac d JOIN user_dnac ud ON d.id = ud.dnac_id"
-        " WHERE user_id = ?"
-        " ORDER BY addr",
+        USER_DNACS,
         (g.user["id"],),
     ).fetchall()
     return render_template("dnacs/index.html", dnacs=dnacs)
@@ -59,9 +56,7 @@ def get_dnac(id):
     dnac = (
         get_db()
         .execute(
-            "SELECT id, addr, dnac_user, dnac_pass, restconf_user, restconf_pass"
-            " FROM dnac d JOIN user_dnac ud ON d.id = ud.dnac_id"
-            " WHERE id = ? AND user_id = ?",
+            USER_DNAC_DETAILS,
             (id, g.user["id"]),
         )
         .fetchone()
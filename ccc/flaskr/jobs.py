@@ -37,7 +37,8 @@ from flask import (Blueprint, flash, g, redirect, render_template, request,
 from werkzeug.exceptions import abort
 
 from flaskr.auth import login_required
-from flaskr.db import get_db
+from flaskr.ccc import first_run, utcnow
+from flaskr.db import DNAC_JOBS, JOB, JOB_NEXT_RUN, USER_DNAC, get_db
 from flaskr.dnacs import get_dnac
 
 actionqueue = queue.Queue(maxsize=10)
@@ -52,9 +53,7 @@ def index(id):
     user_dnac = (
         db
         .execute(
-            "SELECT *"
-            " FROM user_dnac"
-            " WHERE user_id = ? AND dnac_id = ?",
+            USER_DNAC,
             (g.user["id"], id),
         )
         .fetchone()
@@ -62,10 +61,7 @@ def index(id):
     if user_dnac is None:
         abort(403)
     jobs = db.execute(
-        "SELECT j.id, author_id, dnac_id, title, addr, created, frequency, activated"
-        " FROM job j JOIN dnac d ON j.dnac_id = d.id"
-        " WHERE dnac_id = ?"
-        " ORDER BY title",
+        DNAC_JOBS,
         (id,),
     ).fetchall()
     return render_template("jobs/index.html", id=id, jobs=jobs)
@@ -75,9 +71,7 @@ def get_job(id, check_author=True):
     job = (
         get_db()
         .execute(
-            "SELECT *"
-            " FROM job"
-            " WHERE id = ?",
+            JOB,
             (id,),
         )
         .fetchone()
@@ -85,9 +79,7 @@ def get_job(id, check_author=True):
     user_dnac = (
         get_db()
         .execute(
-            "SELECT *"
-            " FROM user_dnac"
-            " WHERE user_id = ? AND dnac_id = ?",
+            USER_DNAC,
             (g.user["id"], job["dnac_id"]),
         )
         .fetchone()
@@ -122,16 +114,18 @@ def create(id):
         if error is not None:
             flash(error)
         else:
+            get_dnac(id)
             db = get_db()
-            db.execute(
+            job = db.execute(
                 "INSERT INTO job (author_id, dnac_id, title, frequency, activated) VALUES (?, ?, ?, ?, ?)",
                 (g.user["id"], id, title, frequency, activated),
-            )
-            job = db.execute(
-                "SELECT last_insert_rowid()",
+            ).lastrowid
+            db.execute(
+                JOB_NEXT_RUN,
+                (first_run(job, frequency, utcnow()).strftime("%Y-%m-%d %H:%M:%S"), job),
             )
             db.commit()
-            actionqueue.put({"action": "create", "job": job, "dnac": get_dnac(id), "frequency": frequency, "activated": activated})
+            actionqueue.put({"action": "create", "job": job})
             return redirect(url_for("jobs.index", id=id))
 
     return render_template("jobs/create.html")
@@ -158,11 +152,12 @@ def update(id, id_job):
         else:
             db = get_db()
             db.execute(
-                "UPDATE job SET created = CURRENT_TIMESTAMP, frequency = ?, activated = ? WHERE id = ?",
-                (frequency, activated, id_job)
+                "UPDATE job SET created = CURRENT_TIMESTAMP, frequency = ?, activated = ?,"
+                " next_run = ? WHERE id = ?",
+                (frequency, activated, first_run(id_job, frequency, utcnow()).strftime("%Y-%m-%d %H:%M:%S"), id_job)
             )
             db.commit()
-            actionqueue.put({"action": "update", "job": id_job, "dnac": get_dnac(id), "frequency": frequency, "activated": activated})
+            actionqueue.put({"action": "update", "job": id_job})
 
     return redirect(url_for("jobs.index", id=id))
 
@@ -0,0 +1,100 @@
+-- Configuration Compliance Check
+--
+-- Copyright (c) 2021 Cisco and/or its affiliates.
+--
+-- This software is licensed to you under the terms of the Cisco Sample
+-- Code License, Version 1.1 (the "License"). You may obtain a copy of the
+-- License at
+--
+--                https://developer.cisco.com/docs/licenses
+--
+-- All use of the material herein must be in accordance with the terms of
+-- the License. All rights not expressly granted by the License are
+-- reserved. Unless required by applicable law or agreed to separately in
+-- writing, software distributed under the License is distributed on an "AS
+-- IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+-- or implied.
+--
+-- AUTHOR(s): Héctor Cavalcanti Saavedra <hcavalca@cisco.com>
+-- CONTRIBUTOR(s): Sarah Louise Justin <sajustin@cisco.com>
+
+-- Move the configurations of the original schema to the content-addressed
+-- blob store and its trigram index, track the latest backups and the time
+-- of each inventory update.
+
+CREATE TABLE blob (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  digest CHAR(64) NOT NULL UNIQUE,
+  content BLOB NOT NULL,
+  compression TEXT
+);
+
+CREATE VIRTUAL TABLE blob_index USING fts5(
+  content,
+  content='',
+  tokenize='trigram'
+);
+
+-- Blobs stay uncompressed until compress-db is run.
+INSERT OR IGNORE INTO blob (digest, content)
+  SELECT sha256(content), content FROM backup ORDER BY id;
+
+INSERT INTO blob_index (rowid, content) SELECT id, content FROM blob;
+
+CREATE TABLE backup_new (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  device_id INTEGER NOT NULL,
+  created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  config_type TEXT NOT NULL,
+  blob_id INTEGER NOT NULL,
+  FOREIGN KEY (device_id) REFERENCES device (id),
+  FOREIGN KEY (blob_id) REFERENCES blob (id)
+);
+
+INSERT INTO backup_new (id, device_id, created, config_type, blob_id)
+  SELECT b.id, device_id, created, config_type, bl.id
+  FROM backup b JOIN blob bl ON bl.digest = sha256(b.content);
+
+DROP TABLE backup;
+ALTER TABLE backup_new RENAME TO backup;
+
+-- Devices saved twice by concurrent inventory updates are merged into the
+-- first one saved, which takes the backups of the others.
+UPDATE backup SET device_id = (
+  SELECT MIN(d.id) FROM device d JOIN device o ON d.dnac_id = o.dnac_id AND d.uuid = o.uuid
+  WHERE o.id = backup.device_id
+)
+WHERE device_id IN (SELECT id FROM device WHERE id NOT IN (SELECT MIN(id) FROM device GROUP BY dnac_id, uuid));
+
+CREATE TABLE latest_backup (
+  device_id INTEGER NOT NULL,
+  config_type TEXT NOT NULL,
+  backup_id INTEGER NOT NULL,
+  PRIMARY KEY (device_id, config_type),
+  FOREIGN KEY (device_id) REFERENCES device (id),
+  FOREIGN KEY (backup_id) REFERENCES backup (id)
+);
+
+INSERT INTO latest_backup (device_id, config_type, backup_id)
+  SELECT device_id, config_type, MAX(id) FROM backup GROUP BY device_id, config_type;
+
+ALTER TABLE dnac ADD COLUMN synced TIMESTAMP;
+
+CREATE TABLE device_new (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  dnac_id INTEGER NOT NULL,
+  uuid CHAR(36) NOT NULL,
+  hostname TEXT NOT NULL,
+  addr TEXT NOT NULL,
+  connected BIT NOT NULL DEFAULT 1,
+  synced TIMESTAMP,
+  UNIQUE (dnac_id, uuid),
+  FOREIGN KEY (dnac_id) REFERENCES dnac (id)
+);
+
+INSERT INTO device_new (id, dnac_id, uuid, hostname, addr, connected)
+  SELECT id, dnac_id, uuid, hostname, addr, connected FROM device
+  WHERE id IN (SELECT MIN(id) FROM device GROUP BY dnac_id, uuid);
+
+DROP TABLE device;
+ALTER TABLE device_new RENAME TO device;
@@ -0,0 +1,33 @@
+-- Configuration Compliance Check
+--
+-- Copyright (c) 2021 Cisco and/or its affiliates.
+--
+-- This software is licensed to you under the terms of the Cisco Sample
+-- Code License, Version 1.1 (the "License"). You may obtain a copy of the
+-- License at
+--
+--                https://developer.cisco.com/docs/licenses
+--
+-- All use of the material herein must be in accordance with the terms of
+-- the License. All rights not expressly granted by the License are
+-- reserved. Unless required by applicable law or agreed to separately in
+-- writing, software distributed under the License is distributed on an "AS
+-- IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+-- or implied.
+--
+-- AUTHOR(s): Héctor Cavalcanti Saavedra <hcavalca@cisco.com>
+-- CONTRIBUTOR(s): Sarah Louise Justin <sajustin@cisco.com>
+
+-- Indexes for the access paths of the pages, the searches and the backups.
+
+-- Versions of a device, by type and date, without reading the backup rows.
+CREATE INDEX backup_device ON backup (device_id, config_type, created);
+
+-- Backups sharing a blob, when searching and purging.
+CREATE INDEX backup_blob ON backup (blob_id);
+
+-- Devices of a DNAC in the order they are listed.
+CREATE INDEX device_hostname ON device (dnac_id, hostname);
+
+-- Jobs of a DNAC in the order they are listed.
+CREATE INDEX job_dnac ON job (dnac_id, title);
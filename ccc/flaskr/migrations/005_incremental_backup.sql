@@ -0,0 +1,27 @@
+-- Configuration Compliance Check
+--
+-- Copyright (c) 2021 Cisco and/or its affiliates.
+--
+-- This software is licensed to you under the terms of the Cisco Sample
+-- Code License, Version 1.1 (the "License"). You may obtain a copy of the
+-- License at
+--
+--                https://developer.cisco.com/docs/licenses
+--
+-- All use of the material herein must be in accordance with the terms of
+-- the License. All rights not expressly granted by the License are
+-- reserved. Unless required by applicable law or agreed to separately in
+-- writing, software distributed under the License is distributed on an "AS
+-- IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+-- or implied.
+--
+-- AUTHOR(s): Héctor Cavalcanti Saavedra <hcavalca@cisco.com>
+-- CONTRIBUTOR(s): Sarah Louise Justin <sajustin@cisco.com>
+
+
+
+-- Last update of each device reported by its DNAC, and the one it had
+-- when its configuration was last backed up, with the time of that backup.
+ALTER TABLE device ADD COLUMN last_update INTEGER;
+ALTER TABLE device ADD COLUMN backup_update INTEGER;
+ALTER TABLE device ADD COLUMN backup_time TIMESTAMP;
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Configuration Compliance Check
+
+Copyright (c) 2021 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+
+"""
+
+
+from __future__ import absolute_import, division, print_function
+
+__author__ = "Héctor Cavalcanti Saavedra <hcavalca@cisco.com>"
+__contributors__ = [
+    "Sarah Louise Justin <sajustin@cisco.com>"
+]
+__copyright__ = "Copyright (c) 2021 Cisco and/or its affiliates."
+__license__ = "Cisco Sample Code License, Version 1.1"
+
+
+
+
+import bisect
+import re
+
+from flaskr.db import match_expression
+
+
+def findall(p, s):
+    '''Yields all the positions of
+    the pattern p in the string s.'''
+    p = p.upper()
+    s = s.upper()
+    
+    i = s.find(p)
+    while i != -1:
+        yield i
+        i = s.find(p, i+1)
+
+
+def split_sections(content):
+    '''Returns the spans of the top-level sections of a
+    configuration: a line that is not indented, followed
+    by all the indented lines under it.'''
+    return [m.span() for m in re.finditer(r"^\S.*(?:\n[ \t].*)*", content, re.MULTILINE)]
+
+
+def compile_query(mode, query, include="", exclude=""):
+    '''Builds the pattern of a search query. Raises re.error
+    if the query is not a valid regular expression.'''
+    query = query.replace("\r\n", "\n")
+
+    if mode == "regex":
+        return Regex(query)
+    elif mode == "any":
+        return Literals(query.splitlines())
+    elif mode == "section":
+        return Section(query.strip("\n"), include.replace("\r\n", "\n").splitlines(), exclude.replace("\r\n", "\n").splitlines())
+    else:
+        return Literals([query])
+
+
+class Literals:
+    '''Any of several literal patterns, case insensitive.
+    They are all looked up in a single pass over the
+    configuration, however many there are.'''
+
+    def __init__(self, patterns):
+        self.patterns = [p for p in patterns if p]
+        # A plain alternation of the upper-cased patterns, searched in
+        # the upper-cased configuration like findall, is much faster
+        # than a case insensitive one. Longest patterns first, so the
+        # longest one wins when several of them match at the same
+        # position.
+        keys = sorted({p.upper() for p in self.patterns}, key=len, reverse=True)
+        self.regex = re.compile("|".join(re.escape(k) for k in keys))
+        # Patterns by the text they match, and the patterns hidden
+        # by a longer one starting with them.
+        self.indexes = {}
+        for i, p in enumerate(self.patterns):
+            self.indexes.setdefault(p.upper(), []).append(i)
+        self.prefixes = {
+            key: [j for j, q in enumerate(self.patterns) if key != q.upper() and key.startswith(q.upper())]
+            for key in self.indexes
+        }
+
+    @property
+    def expression(self):
+        '''Full-text expression selecting the configurations that
+        may match, or None if the index cannot be used.'''
+        expressions = [match_expression(p) for p in self.patterns]
+        if not expressions or None in expressions:
+            return None
+
+        return " OR ".join(expressions)
+
+    def positions(self, content):
+        '''Yields (start, end, pattern index) for every occurrence
+        of every pattern in content.'''
+        # Each search starts right after the start of the previous
+        # match, so that overlapping occurrences are found too.
+        content = content.upper()
+        m = self.regex.search(content)
+        while m is not None:
+            key = m.group()
+            for i in self.indexes[key]:
+                yield m.start(), m.end(), i
+            for j in self.prefixes[key]:
+                yield m.start(), m.start() + len(self.patterns[j]), j
+            m = self.regex.search(content, m.start() + 1)
+
+    def scan(self, content):
+        if not self.patterns:
+            return []
+        elif len(self.patterns) == 1:
+            return [(i, i+len(self.patterns[0])) for i in findall(self.patterns[0], content)]
+
+        return [(start, end) for start, end, i in self.positions(content)]
+
+
+class Regex:
+    '''A regular expression, in which ^ and $ match at
+    the beginning and the end of each line.'''
+
+    expression = None
+
+    def __init__(self, pattern):
+        self.regex = re.compile(pattern, re.MULTILINE)
+
+    def scan(self, content):
+        return [m.span() for m in self.regex.finditer(content) if m.end() > m.start()]
+
+
+class Section:
+    '''Top-level sections whose first line starts with header
+    and which contain every include pattern and none of the
+    exclude patterns, e.g. the interface sections containing
+    "switchport mode access" but not "spanning-tree portfast".'''
+
+    def __init__(self, header, include=(), exclude=()):
+        self.header = header
+        self.include = [p for p in include if p]
+        self.exclude = [p for p in exclude if p]
+        self.literals = Literals(self.include + self.exclude)
+
+    @property
+    def expression(self):
+        expressions = [match_expression(p) for p in [self.header] + self.include]
+        expressions = [e for e in expressions if e is not None]
+        if not expressions:
+            return None
+
+        return " AND ".join(expressions)
+
+    def scan(self, content):
+        sections = [
+            s for s in split_sections(content)
+            if content[s[0]:s[0] + len(self.header)].upper() == self.header.upper()
+        ]
+        if not sections:
+            return []
+
+        starts = [s[0] for s in sections]
+        found = [set() for s in sections]
+        if self.literals.patterns:
+            for start, end, i in self.literals.positions(content):
+                k = bisect.bisect_right(starts, start) - 1
+                if k >= 0 and end <= sections[k][1]:
+                    found[k].add(i)
+
+        include = set(range(len(self.include)))
+        return [
+            sections[k] for k in range(len(sections))
+            if include <= found[k] and not found[k] - include
+        ]
@@ -20,11 +20,15 @@
 
 -- Initialize the database.
 -- Drop any existing data and create empty tables.
+-- Keep in sync with the migrations, which upgrade existing databases.
 
 DROP TABLE IF EXISTS user_dnac;
 DROP TABLE IF EXISTS user;
 DROP TABLE IF EXISTS job;
+DROP TABLE IF EXISTS latest_backup;
 DROP TABLE IF EXISTS backup;
+DROP TABLE IF EXISTS blob;
+DROP TABLE IF EXISTS blob_index;
 DROP TABLE IF EXISTS device;
 DROP TABLE IF EXISTS dnac;
 
@@ -36,7 +40,8 @@ CREATE TABLE user (
 
 CREATE TABLE dnac (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
-  addr TEXT NOT NULL UNIQUE
+  addr TEXT NOT NULL UNIQUE,
+  synced TIMESTAMP
 );
 
 CREATE TABLE user_dnac (
@@ -59,6 +64,7 @@ CREATE TABLE job (
   title TEXT NOT NULL,
   frequency UNSIGNED INTEGER NOT NULL,
   activated BIT NOT NULL DEFAULT 1,
+  next_run TIMESTAMP,
   FOREIGN KEY (author_id) REFERENCES user (id),
   FOREIGN KEY (dnac_id) REFERENCES dnac (id)
 );
@@ -70,14 +76,52 @@ CREATE TABLE device (
   hostname TEXT NOT NULL,
   addr TEXT NOT NULL,
   connected BIT NOT NULL DEFAULT 1,
+  synced TIMESTAMP,
+  last_update INTEGER,
+  backup_update INTEGER,
+  backup_time TIMESTAMP,
+  UNIQUE (dnac_id, uuid),
   FOREIGN KEY (dnac_id) REFERENCES dnac (id)
 );
 
+CREATE TABLE blob (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  digest CHAR(64) NOT NULL UNIQUE,
+  content BLOB NOT NULL,
+  compression TEXT
+);
+
+-- Trigram index over the text of each blob, keyed by blob id. It is
+-- contentless: the compressed blob stays the only copy of the text.
+CREATE VIRTUAL TABLE blob_index USING fts5(
+  content,
+  content='',
+  tokenize='trigram'
+);
+
 CREATE TABLE backup (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   device_id INTEGER NOT NULL,
   created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
   config_type TEXT NOT NULL,
-  content LONGTEXT NOT NULL,
-  FOREIGN KEY (device_id) REFERENCES device (id)
-);
\ No newline at end of file
+  blob_id INTEGER NOT NULL,
+  FOREIGN KEY (device_id) REFERENCES device (id),
+  FOREIGN KEY (blob_id) REFERENCES blob (id)
+);
+
+-- Latest backup of each device for each configuration type, kept up to
+-- date on every backup and purge.
+CREATE TABLE latest_backup (
+  device_id INTEGER NOT NULL,
+  config_type TEXT NOT NULL,
+  backup_id INTEGER NOT NULL,
+  PRIMARY KEY (device_id, config_type),
+  FOREIGN KEY (device_id) REFERENCES device (id),
+  FOREIGN KEY (backup_id) REFERENCES backup (id)
+);
+
+CREATE INDEX backup_device ON backup (device_id, config_type, created);
+CREATE INDEX backup_history ON backup (device_id, created);
+CREATE INDEX backup_blob ON backup (blob_id);
+CREATE INDEX device_hostname ON device (dnac_id, hostname);
+CREATE INDEX job_dnac ON job (dnac_id, title);
\ No newline at end of file
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Configuration Compliance Check
+
+Copyright (c) 2021 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+
+"""
+
+
+from __future__ import absolute_import, division, print_function
+
+__author__ = "Héctor Cavalcanti Saavedra <hcavalca@cisco.com>"
+__contributors__ = [
+    "Sarah Louise Justin <sajustin@cisco.com>"
+]
+__copyright__ = "Copyright (c) 2021 Cisco and/or its affiliates."
+__license__ = "Cisco Sample Code License, Version 1.1"
+
+
+
+
+import pytest
+
+from flaskr import create_app
+from flaskr.db import init_db
+
+
+@pytest.fixture
+def app(tmp_path):
+    """Create and configure a new app instance for each test."""
+    # create the app with a temporary database
+    app = create_app({"TESTING": True, "DATABASE": str(tmp_path / "flaskr.sqlite")})
+
+    # create the database with the current schema
+    with app.app_context():
+        init_db()
+
+    yield app
+
+
+@pytest.fixture
+def runner(app):
+    """A test runner for the app's Click commands."""
+    return app.test_cli_runner()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Configuration Compliance Check
+
+Copyright (c) 2021 Cisco and/or its affiliates.
+
+This software is licensed to you under the terms of the Cisco Sample
+Code License, Version 1.1 (the "License"). You may obtain a copy of the
+License at
+
+               https://developer.cisco.com/docs/licenses
+
+All use of the material herein must be in accordance with the terms of
+the License. All rights not expressly granted by the License are
+reserved. Unless required by applicable law or agreed to separately in
+writing, software distributed under the License is distributed on an "AS
+IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied.
+
+"""
+
+
+from __future__ import absolute_import, division, print_function
+
+__author__ = "Héctor Cavalcanti Saavedra <hcavalca@cisco.com>"
+__contributors__ = [
+    "Sarah Louise Justin <sajustin@cisco.com>"
+]
+__copyright__ = "Copyright (c) 2021 Cisco and/or its affiliates."
+__license__ = "Cisco Sample Code License, Version 1.1"
+
+
+
+
+import time
+
+from flaskr.patterns import Literals, Section, findall
+
+
+def make_config(size):
+    lines = ["hostname sw1", "aaa new-model", "!"]
+    length = 0
+    i = 0
+    while length < size:
+        interface = [
+            "interface GigabitEthernet1/0/{}".format(i),
+            " description port {}".format(i),
+            " switchport access vlan {}".format(i % 90),
+            " switchport mode access" if i % 3 else " switchport mode trunk",
+            " spanning-tree portfast" if i % 2 else " storm-control broadcast level 1.00",
+            " no shutdown" if i % 5 else " shutdown",
+            "!",
+        ]
+        lines += interface
+        length += sum(len(line) + 1 for line in interface)
+        i += 1
+    return "\n".join(lines)
+
+
+def best_time(f, repeat=5):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def test_literals_case_insensitive():
+    assert Literals(["Shutdown", "VLAN 7"]).scan("interface a\n shutdown\n vlan 7\n") == [(13, 21), (23, 29)]
+
+
+def test_literals_overlapping_and_prefixes():
+    literals = Literals(["aa", "a", "AAA"])
+
+    assert sorted(literals.positions("aaa")) == [
+        (0, 1, 1), (0, 2, 0), (0, 3, 2), (1, 2, 1), (1, 3, 0), (2, 3, 1),
+    ]
+
+
+def test_literals_same_pattern_twice():
+    assert sorted(Literals(["no shut", "NO SHUT"]).positions(" no shut")) == [(1, 8, 0), (1, 8, 1)]
+
+
+def test_section_include_exclude():
+    content = (
+        "interface Gi1/0/1\n switchport mode access\n spanning-tree portfast\n"
+        "interface Gi1/0/2\n switchport mode access\n"
+        "router ospf 1\n switchport mode access\n"
+    )
+    sections = Section("interface", ["switchport mode access"], ["spanning-tree portfast"]).scan(content)
+
+    assert [content[start:end].splitlines()[0] for start, end in sections] == ["interface Gi1/0/2"]
+
+
+def test_literals_not_slower_than_each_pattern():
+    # dozens of audit patterns over a large configuration
+    content = make_config(1_500_000)
+    patterns = ["switchport mode trunk", "shutdown", "ip http server", "vlan 7\n"] + [
+        "logging host 10.0.0.{}".format(i) for i in range(48)
+    ]
+    literals = Literals(patterns)
+
+    assert sorted(literals.scan(content)) == sorted(
+        (i, i + len(p)) for p in patterns for i in findall(p, content)
+    )
+    assert best_time(lambda: literals.scan(content)) <= best_time(
+        lambda: [list(findall(p, content)) for p in patterns]
+    )